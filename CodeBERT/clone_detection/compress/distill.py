@@ -1,4 +1,6 @@
 import os
+import sys
+import time
 import torch
 import logging
 import argparse
@@ -7,9 +9,12 @@ import numpy as np
 import torch.nn.functional as F
 import csv
 
+sys.path.append("../../common")
+
 from tqdm import tqdm
 from models import Model, distill_loss
 from utils import set_seed, DistilledDataset
+from student_data import BucketBatchSampler, collate_batch
 from sklearn.metrics import recall_score, precision_score, f1_score
 from torch.utils.data import DataLoader, SequentialSampler, RandomSampler
 from transformers import AdamW, get_linear_schedule_with_warmup, RobertaConfig, RobertaModel
@@ -44,8 +49,11 @@ def train(args, model, train_dataloader, eval_dataloader):
         logger.info("Epoch [{}/{}]".format(epoch + 1, args.epochs))
         bar = tqdm(train_dataloader, total=len(train_dataloader))
         bar.set_description("Train")
+        n_examples = 0
+        start = time.time()
         for batch in bar:
             texts = batch[0].to("cuda")
+            n_examples += texts.size(0)
             soft_knowledge = batch[3].to("cuda")
             
             preds = model(texts)
@@ -59,6 +67,7 @@ def train(args, model, train_dataloader, eval_dataloader):
             scheduler.step()
             optimizer.zero_grad()
 
+        logger.info("Train throughput: %.1f examples/s", n_examples/(time.time() - start))
         dev_results = evaluate(model, eval_dataloader)
         dev_acc = dev_results["eval_acc"]
         if dev_acc >= dev_best_acc:
@@ -88,6 +97,7 @@ def evaluate(model, eval_dataloader):
     with torch.no_grad():
         bar = tqdm(eval_dataloader, total=len(eval_dataloader))
         bar.set_description("Evaluation")
+        start = time.time()
         for batch in bar:
             texts = batch[0].to("cuda")
             label = batch[1].to("cuda")
@@ -96,6 +106,7 @@ def evaluate(model, eval_dataloader):
             predict_all.append(prob.cpu().numpy())
             labels_all.append(label.cpu().numpy())
 
+    logger.info("Evaluation throughput: %.1f examples/s", len(eval_dataloader.dataset)/(time.time() - start))
     predict_all = np.concatenate(predict_all, 0)
     labels_all = np.concatenate(labels_all, 0)
 
@@ -148,6 +159,8 @@ def main():
                         help="Batch size per GPU/CPU for evaluation.")
     parser.add_argument("--learning_rate", default=1e-3, type=float,
                         help="The initial learning rate for Adam.")
+    parser.add_argument("--length_bucketing", action="store_true",
+                        help="Batch examples of similar length together and trim their padding (the student masks padding).")
     parser.add_argument("--seed", type=int, default=42,
                         help="random seed for initialization")
     parser.add_argument("--epochs", type=int, default=42,
@@ -187,15 +200,24 @@ def main():
     # if args.do_train:
     train_dataset = DistilledDataset(
         args, args.vocab_size, args.train_data_file, logger)
-    train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(
-        train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    if args.length_bucketing:
+        train_dataloader = DataLoader(train_dataset, batch_sampler=BucketBatchSampler(
+            train_dataset.lengths, args.train_batch_size), collate_fn=collate_batch)
+    else:
+        train_sampler = RandomSampler(train_dataset)
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler,
+                                      batch_size=args.train_batch_size)
 
     eval_dataset = DistilledDataset(
         args, args.vocab_size, args.eval_data_file, logger)
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler,
-                                 batch_size=args.eval_batch_size, num_workers=8, pin_memory=True)
+    if args.length_bucketing:
+        eval_dataloader = DataLoader(eval_dataset, batch_sampler=BucketBatchSampler(
+            eval_dataset.lengths, args.eval_batch_size, shuffle=False), collate_fn=collate_batch,
+            num_workers=8, pin_memory=True)
+    else:
+        eval_sampler = SequentialSampler(eval_dataset)
+        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,
+                                     num_workers=8, pin_memory=True)
 
     model.to(args.device)
 
@@ -1,4 +1,5 @@
 import os
+import time
 import torch
 import logging
 import argparse
@@ -42,8 +43,11 @@ def train(args, model, train_dataloader, eval_dataloader):
         logger.info("Epoch [{}/{}]".format(epoch + 1, args.epochs))
         bar = tqdm(train_dataloader, total=len(train_dataloader))
         bar.set_description("Train")
+        n_examples = 0
+        start = time.time()
         for batch in bar:
             texts = batch[0].to("cuda")
+            n_examples += texts.size(0)
             soft_knowledge = batch[3].to("cuda")
 
             preds = model(texts)
@@ -57,6 +61,7 @@ def train(args, model, train_dataloader, eval_dataloader):
             scheduler.step()
             optimizer.zero_grad()
 
+        logger.info("Train throughput: %.1f examples/s", n_examples/(time.time() - start))
         dev_results = evaluate(model, eval_dataloader)
         dev_acc = dev_results["eval_acc"]
         if dev_acc >= dev_best_acc:
@@ -86,6 +91,7 @@ def evaluate(model, eval_dataloader):
     with torch.no_grad():
         bar = tqdm(eval_dataloader, total=len(eval_dataloader))
         bar.set_description("Evaluation")
+        start = time.time()
         for batch in bar:
             texts = batch[0].to("cuda")
             label = batch[1].to("cuda")
@@ -94,6 +100,7 @@ def evaluate(model, eval_dataloader):
             predict_all.append(prob.cpu().numpy())
             labels_all.append(label.cpu().numpy())
 
+    logger.info("Evaluation throughput: %.1f examples/s", len(eval_dataloader.dataset)/(time.time() - start))
     predict_all = np.concatenate(predict_all, 0)
     labels_all = np.concatenate(labels_all, 0)
 
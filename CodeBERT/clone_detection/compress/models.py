@@ -22,7 +22,7 @@ class LSTM(nn.Module):
         self.fc = nn.Linear(hidden_dim, n_labels)
 
     def forward(self, input_ids, labels=None):
-        input_ids = input_ids.view(-1, 400)
+        input_ids = input_ids.view(-1, input_ids.size(-1))
         embed = self.embedding(input_ids)
         outputs, (hidden, _) = self.lstm(embed)
         hidden = hidden.permute(1, 0, 2)
@@ -57,6 +57,7 @@ class biLSTM(nn.Module):
         self.dropout = nn.Dropout(0.1)
 
     def forward(self, input_ids, labels=None):
+        input_ids = input_ids.view(input_ids.size(0), -1)
         embed = self.embedding(input_ids)
         outputs, (hidden, _) = self.lstm(embed)
         hidden = hidden.permute(1, 0, 2)
@@ -89,7 +90,7 @@ class GRU(nn.Module):
         self.fc = nn.Linear(hidden_dim, n_labels)
 
     def forward(self, input_ids, labels=None):
-        input_ids = input_ids.view(-1, 400)
+        input_ids = input_ids.view(-1, input_ids.size(-1))
         embed = self.embedding(input_ids)
         _, hidden = self.gru(embed)
         hidden = hidden.permute(1, 0, 2)
@@ -123,7 +124,7 @@ class biGRU(nn.Module):
         self.fc = nn.Linear(hidden_dim * 2, n_labels)
 
     def forward(self, input_ids, labels=None):
-        input_ids = input_ids.view(-1, 400)
+        input_ids = input_ids.view(-1, input_ids.size(-1))
         embed = self.embedding(input_ids)
         _, hidden = self.gru(embed)
         hidden = hidden.permute(1, 0, 2)
@@ -178,7 +179,7 @@ class Transformer(nn.Module):
         self.input_dim = input_dim
 
     def forward(self, input_ids, labels=None):
-        input_ids = input_ids.view(-1, 400)
+        input_ids = input_ids.view(-1, input_ids.size(-1))
         embed = self.embedding(input_ids) * math.sqrt(self.input_dim)
         embed = self.pos_encoder(embed)
         hidden = self.transformer_encoder(embed)
@@ -262,7 +263,7 @@ class Model(nn.Module):
         # self.args = args
 
     def forward(self, input_ids=None, labels=None):
-        input_ids = input_ids.view(-1, 400)
+        input_ids = input_ids.view(-1, input_ids.size(-1))
         outputs = self.encoder(input_ids=input_ids,
                                attention_mask=input_ids.ne(1))[0]
         # print(outputs.shape)
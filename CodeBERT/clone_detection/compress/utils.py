@@ -1,12 +1,16 @@
 import os
+import sys
 import json
 import torch
 import random
 import multiprocessing
 import numpy as np
 
+sys.path.append("../../common")
+
 from tqdm import tqdm
 from torch.utils.data import Dataset
+from student_data import SequenceEncoder, feature_cache_dir, save_features, load_features
 from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers, processors, normalizers
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -36,15 +40,34 @@ def BPE(args, texts, vocab_size, file_path, logger):
 
 
 class DistilledDataset(Dataset):
+    """Clone pairs stored column-wise in memory-mapped arrays: one int32 padded
+    id row per unique function in func_ids, and per pair the two function rows,
+    label, pred and soft label. Items are [2, block_size] id matrices; lengths
+    holds the longer function length of each pair for bucketing.
+    The columns are cached on disk and reused while the pair file, code file,
+    soft labels, tokenizer, vocab_size and block_size are unchanged."""
+
     def __init__(self, args, vocab_size, file_path, logger):
         postfix = file_path.split("/")[-1].split(".")[0]
-        self.examples = []
-        logger.info("Creating features from file at %s ", file_path)
-
-        url_to_code = {}
         folder = "/".join(file_path.split("/")[:-1])
+        code_path = os.path.join(folder, "data.jsonl")
+        soft_label_path = os.path.join(folder, "preds_unlabel_train.npy")
+        tokenizer_path = os.path.join(
+            folder, "BPE" + "_" + str(vocab_size) + ".json")
+        inputs = [file_path, code_path, tokenizer_path]
+        if "train" in postfix:
+            inputs.append(soft_label_path)
 
-        with open("/".join(file_path.split("/")[:-1])+"/data.jsonl") as f:
+        if os.path.exists(tokenizer_path):
+            cache_dir = feature_cache_dir(folder, postfix, inputs, vocab_size, args.block_size)
+            if os.path.exists(cache_dir):
+                logger.info("Loading features from cache %s", cache_dir)
+                self.set_features(load_features(cache_dir))
+                return
+
+        logger.info("Creating features from file at %s ", file_path)
+        url_to_code = {}
+        with open(code_path) as f:
             for line in f:
                 line = line.strip()
                 js = json.loads(line)
@@ -76,11 +99,7 @@ class DistilledDataset(Dataset):
                     label = pred
                     # label = -1
 
-                data.append((url1, url2, label, pred, args, url_to_code))
-
-
-        tokenizer_path = os.path.join(
-            folder, "BPE" + "_" + str(vocab_size) + ".json")
+                data.append((url1, url2, label, pred))
 
         if os.path.exists(tokenizer_path):
             tokenizer = Tokenizer.from_file(tokenizer_path)
@@ -93,49 +112,71 @@ class DistilledDataset(Dataset):
             tokenizer = BPE(args, texts, vocab_size, file_path, logger)
 
         if "train" in postfix:
-            soft_labels = np.load(os.path.join(
-                folder, "preds_unlabel_train.npy")).tolist()
-
-        _mp_data = []
-        for i, d in enumerate(data):
-            lst = list(d)
-            lst.append(tokenizer)
-            if "train" in postfix:
-                lst.append(soft_labels[i])
-            else:
-                lst.append([0.1, 0.1])
-            _mp_data.append(tuple(lst))
-
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        self.examples = pool.map(
-            preprocess, tqdm(_mp_data, total=len(_mp_data)))
+            soft_labels = np.load(soft_label_path)[:len(data)].astype(np.float32)
+        else:
+            soft_labels = np.full((len(data), 2), 0.1, dtype=np.float32)
+
+        # encode each function once, then build pairs as lookups into its rows
+        urls = list(dict.fromkeys(url for d in data for url in d[:2]))
+        logger.info("%d unique functions for %d pairs", len(urls), len(data))
+        chunks = [urls[i:i + 1024] for i in range(0, len(urls), 1024)]
+
+        # the code map and tokenizer reach each worker once, through the pool
+        # initializer (inherited by fork on Linux), instead of once per task
+        encoder = SequenceEncoder(tokenizer, args.block_size)
+        pool = multiprocessing.Pool(multiprocessing.cpu_count(), initializer=init_worker,
+                                    initargs=(url_to_code, encoder))
+        func_ids = np.zeros((0, args.block_size), dtype=np.int32)
+        if len(chunks) > 0:
+            func_ids = np.concatenate(list(tqdm(pool.imap(encode_functions, chunks), total=len(chunks))))
+        pool.close()
+        pool.join()
+
+        url_to_row = {url: row for row, url in enumerate(urls)}
+        features = {
+            "func_ids": func_ids,
+            "func_lengths": (func_ids != encoder.pad).sum(1).astype(np.int32),
+            "pairs": np.array([(url_to_row[d[0]], url_to_row[d[1]]) for d in data],
+                              dtype=np.int64).reshape(-1, 2),
+            "label": np.array([d[2] for d in data], dtype=np.int64),
+            "pred": np.array([d[3] for d in data], dtype=np.int64),
+            "soft_label": soft_labels
+        }
+        cache_dir = feature_cache_dir(folder, postfix, inputs, vocab_size, args.block_size)
+        save_features(cache_dir, features)
+        logger.info("Saving features to cache %s", cache_dir)
+        self.set_features(load_features(cache_dir))
+
+    def set_features(self, features):
+        self.func_ids = features["func_ids"]
+        self.pairs = features["pairs"]
+        self.lengths = features["func_lengths"][self.pairs].max(1)
+        self.label = features["label"]
+        self.pred = features["pred"]
+        self.soft_label = features["soft_label"]
 
     def __len__(self):
-        return len(self.examples)
+        return len(self.label)
 
     def __getitem__(self, i):
-        return torch.tensor(self.examples[i].input_ids), torch.tensor(self.examples[i].label), torch.tensor(self.examples[i].pred), torch.tensor(self.examples[i].soft_label)
+        input_ids = self.func_ids[self.pairs[i]]
+        return torch.from_numpy(input_ids), torch.tensor(self.label[i]), torch.tensor(self.pred[i]), torch.from_numpy(self.soft_label[i])
+
+
+_worker_url_to_code = None
+_worker_encoder = None
 
 
-def preprocess(item):
-    url1, url2, label, pred, args, url_to_code, tokenizer, s = item
-    code1 = " ".join(url_to_code[url1].split())
-    code2 = " ".join(url_to_code[url2].split())
-    code1_ids = tokenizer.encode(code1).ids[:args.block_size-2]
-    code2_ids = tokenizer.encode(code2).ids[:args.block_size-2]
-    code1_ids = [tokenizer.token_to_id(
-        "<s>")]+code1_ids+[tokenizer.token_to_id("</s>")]
-    code2_ids = [tokenizer.token_to_id(
-        "<s>")]+code2_ids+[tokenizer.token_to_id("</s>")]
-    padding_length = args.block_size - len(code1_ids)
-    code1_ids += [tokenizer.token_to_id("<pad>")] * padding_length
-    padding_length = args.block_size - len(code2_ids)
-    code2_ids += [tokenizer.token_to_id("<pad>")] * padding_length
+def init_worker(url_to_code, encoder):
+    global _worker_url_to_code, _worker_encoder
+    _worker_url_to_code = url_to_code
+    _worker_encoder = encoder
 
-    source_tokens = code1 + code2
-    source_ids = code1_ids + code2_ids
 
-    return InputFeatures(source_tokens, source_ids, label, pred, s)
+def encode_functions(urls):
+    """Pool task: encodes a chunk of functions into an int32 [len(urls), block_size]
+    matrix of <s> ids </s> rows padded with <pad>."""
+    return _worker_encoder.encode([_worker_url_to_code[url] for url in urls])
 
 
 def set_seed(seed=42):
@@ -145,18 +186,3 @@ def set_seed(seed=42):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.backends.cudnn.deterministic = True
-
-
-class InputFeatures(object):
-    def __init__(self,
-                 input_tokens,
-                 input_ids,
-                 label,
-                 pred,
-                 soft_label=[0.1, 0.1]
-                 ):
-        self.input_tokens = input_tokens
-        self.input_ids = input_ids
-        self.label = label
-        self.pred = pred
-        self.soft_label = soft_label
\ No newline at end of file
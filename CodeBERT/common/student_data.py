@@ -0,0 +1,108 @@
+import os
+import shutil
+import hashlib
+import torch
+import numpy as np
+
+from torch.utils.data import Sampler
+
+# bump when the stored features change, so stale caches are not read back
+FEATURE_CACHE_VERSION = 2
+
+
+class SequenceEncoder(object):
+    """Encodes functions into <s> ids </s> rows right-padded with <pad> and
+    truncated to block_size, written straight into int32 NumPy rows. The
+    special ids are resolved once, on construction."""
+
+    def __init__(self, tokenizer, block_size):
+        self.tokenizer = tokenizer
+        self.block_size = block_size
+        self.bos = tokenizer.token_to_id("<s>")
+        self.eos = tokenizer.token_to_id("</s>")
+        self.pad = tokenizer.token_to_id("<pad>")
+
+    def encode(self, funcs):
+        return self.encode_into(funcs, np.empty((len(funcs), self.block_size), dtype=np.int32))
+
+    def encode_into(self, funcs, out):
+        codes = [" ".join(func.split()) for func in funcs]
+        for row, encoding in zip(out, self.tokenizer.encode_batch(codes)):
+            ids = encoding.ids[:self.block_size-2]
+            row[0] = self.bos
+            row[1:len(ids)+1] = ids
+            row[len(ids)+1] = self.eos
+            row[len(ids)+2:] = self.pad
+        return out
+
+
+def feature_cache_dir(folder, postfix, paths, *params):
+    """Cache directory named after a SHA1 of the input files' contents and the
+    parameters, so any change to them selects a fresh directory."""
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    sha.update(repr((FEATURE_CACHE_VERSION,) + params).encode("UTF-8"))
+    return os.path.join(folder, "cache", postfix + "_" + sha.hexdigest()[:16])
+
+
+def save_features(cache_dir, features):
+    # write into a private directory first so readers never see a partial cache
+    tmp_dir = "%s.%d.tmp" % (cache_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, array in features.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), array)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)  # another run cached the same features meanwhile
+
+
+def load_features(cache_dir):
+    # copy-on-write memory maps: pages come from the OS page cache and are
+    # shared by DataLoader workers, yet torch.from_numpy gets writable arrays
+    return {name[:-len(".npy")]: np.load(os.path.join(cache_dir, name), mmap_mode="c")
+            for name in os.listdir(cache_dir) if name.endswith(".npy")}
+
+
+def collate_batch(batch, pad_id=1):
+    """Stacks a batch and trims the ids to its longest sequence. Rows are
+    right-padded, so trimming only drops padding columns."""
+    input_ids, label, pred, soft_label = (torch.stack(column) for column in zip(*batch))
+    max_len = int(input_ids.ne(pad_id).sum(-1).max())
+    return input_ids[..., :max_len].contiguous(), label, pred, soft_label
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of examples with similar lengths, so dynamic padding trims most
+    of each batch. With shuffle, a random permutation is cut into pools of
+    bucket_size batches, each pool is sorted by length and the batch order is
+    shuffled; without it, all examples are sorted by length."""
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths)).numpy()
+            pool_size = self.batch_size * self.bucket_size
+            pools = [order[i:i + pool_size] for i in range(0, len(order), pool_size)]
+        else:
+            pools = [np.arange(len(self.lengths))]
+
+        batches = []
+        for pool in pools:
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
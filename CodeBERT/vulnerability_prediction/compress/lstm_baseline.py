@@ -1,4 +1,5 @@
 import os
+import time
 import torch
 import logging
 import argparse
@@ -9,7 +10,7 @@ import csv
 from tqdm import tqdm
 import torch.nn.functional as F
 from models import biLSTM, mse_loss
-from utils import set_seed, DistilledDataset
+from utils import set_seed, DistilledDataset, StreamingDistilledDataset
 
 from sklearn.metrics import recall_score, precision_score, f1_score
 from torch.utils.data import DataLoader, SequentialSampler, RandomSampler
@@ -42,8 +43,11 @@ def train(args, model, train_dataloader, eval_dataloader):
         logger.info('Epoch [{}/{}]'.format(epoch + 1, args.epochs))
         bar = tqdm(train_dataloader, total=len(train_dataloader))
         bar.set_description("Train")
+        n_examples = 0
+        start = time.time()
         for batch in bar:
             texts = batch[0].to("cuda")
+            n_examples += texts.size(0)
             labels = batch[1].to("cuda")
             knowledge = batch[2].to("cuda")
             soft_knowledge = batch[3].to("cuda")
@@ -59,6 +63,7 @@ def train(args, model, train_dataloader, eval_dataloader):
             scheduler.step()
             optimizer.zero_grad()
 
+        logger.info("Train throughput: %.1f examples/s", n_examples/(time.time() - start))
         dev_results = evaluate(model, eval_dataloader)
         dev_acc = dev_results["eval_acc"]
         if dev_acc >= dev_best_acc:
@@ -83,6 +88,7 @@ def evaluate(model, eval_dataloader):
     with torch.no_grad():
         bar = tqdm(eval_dataloader, total=len(eval_dataloader))
         bar.set_description("Evaluation")
+        start = time.time()
         for batch in bar:
             texts = batch[0].to("cuda")
             label = batch[1].to("cuda")
@@ -94,6 +100,7 @@ def evaluate(model, eval_dataloader):
             predict_all.append(prob.cpu().numpy())
             labels_all.append(label.cpu().numpy())
     # print(sum(time_count)/len(time_count))
+    logger.info("Evaluation throughput: %.1f examples/s", len(eval_dataloader.dataset)/(time.time() - start))
     predict_all = np.concatenate(predict_all, 0)
     labels_all = np.concatenate(labels_all, 0)
 
@@ -142,6 +149,10 @@ def main():
                         help="Batch size per GPU/CPU for evaluation.")
     parser.add_argument("--learning_rate", default=5e-4, type=float,
                         help="The initial learning rate for Adam.")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Stream the training file instead of loading it into memory.")
+    parser.add_argument("--shuffle_buffer", default=10000, type=int,
+                        help="Examples buffered to shuffle the training stream; 0 keeps file order.")
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
     parser.add_argument('--epochs', type=int, default=42,
@@ -171,13 +182,22 @@ def main():
     
     model = biLSTM(args.vocab_size, 300, args.hidden_dim, n_labels, args.n_layers)
 
-    train_dataset = DistilledDataset(args, args.vocab_size, args.train_data_file, logger)
-    train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    if args.streaming:
+        train_dataset = StreamingDistilledDataset(
+            args, args.vocab_size, args.train_data_file, logger, args.shuffle_buffer,
+            batch_size=args.train_batch_size)
+        train_dataloader = DataLoader(train_dataset, batch_size=args.train_batch_size,
+                                      num_workers=8, pin_memory=True)
+    else:
+        train_dataset = DistilledDataset(args, args.vocab_size, args.train_data_file, logger)
+        train_sampler = RandomSampler(train_dataset)
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler,
+                                      batch_size=args.train_batch_size)
     
     eval_dataset = DistilledDataset(args, args.vocab_size, args.eval_data_file, logger)
     eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size, num_workers=8, pin_memory=True)
+    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler,
+                                 batch_size=args.eval_batch_size, num_workers=8, pin_memory=True)
     
     model.to(args.device)
 
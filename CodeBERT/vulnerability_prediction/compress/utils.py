@@ -1,17 +1,20 @@
 import os
+import sys
 import json
+import time
 import torch
 import random
 import numpy as np
 
+sys.path.append("../../common")
+
 from tqdm import tqdm
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from student_data import SequenceEncoder, feature_cache_dir, save_features, load_features
 from tokenizers.pre_tokenizers import Whitespace
 from tokenizers.trainers import WordLevelTrainer
 from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers, processors, normalizers
 
-os.environ["TOKENIZERS_PARALLELISM"] = "false"
-
 
 def BPE(texts, vocab_size, file_path, logger):
     tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
@@ -37,19 +40,30 @@ def BPE(texts, vocab_size, file_path, logger):
 
 
 class DistilledDataset(Dataset):
+    """Functions stored column-wise in memory-mapped arrays: an int32
+    [N, block_size] padded id matrix plus label, pred and soft-label arrays.
+    The columns are cached on disk and reused while the data file, tokenizer,
+    vocab_size and block_size are unchanged."""
+
     def __init__(self, args, vocab_size, file_path, logger):
         postfix = file_path.split("/")[-1].split(".")[0]
-        self.examples = []
-        logger.info("Creating features from file at %s ", file_path)
-
         folder = "/".join(file_path.split("/")[:-1])
+        tokenizer_path = os.path.join(
+            folder, "BPE" + "_" + str(vocab_size) + ".json")
+        inputs = [file_path, tokenizer_path]
+
+        if os.path.exists(tokenizer_path):
+            cache_dir = feature_cache_dir(folder, postfix, inputs, vocab_size, args.block_size)
+            if os.path.exists(cache_dir):
+                logger.info("Loading features from cache %s", cache_dir)
+                self.set_features(load_features(cache_dir))
+                return
 
+        logger.info("Creating features from file at %s ", file_path)
         data = []
         with open(file_path) as f:
             for line in f:
                 data.append(json.loads(line.strip()))
-        tokenizer_path = os.path.join(
-            folder, "BPE" + "_" + str(vocab_size) + ".json")
 
         if os.path.exists(tokenizer_path):
             tokenizer = Tokenizer.from_file(tokenizer_path)
@@ -58,25 +72,133 @@ class DistilledDataset(Dataset):
             texts = [" ".join(d["func"].split()) for d in data]
             tokenizer = BPE(texts, vocab_size, file_path, logger)
 
-        for d in tqdm(data):
-            code = " ".join(d["func"].split())
-            source_ids = tokenizer.encode(code).ids[:args.block_size-2]
-            source_ids = [tokenizer.token_to_id(
-                "<s>")]+source_ids+[tokenizer.token_to_id("</s>")]
-            padding_length = args.block_size - len(source_ids)
-            source_ids += [tokenizer.token_to_id("<pad>")] * padding_length
-            if "train" in postfix:
-                self.examples.append(
-                    (InputFeatures(code, source_ids, d["pred"], d["pred"], d["soft_label"])))
-            else:
-                self.examples.append(
-                    (InputFeatures(code, source_ids, d["target"])))
+        # encode_batch tokenizes each chunk on the Rust tokenizer's thread pool
+        start = time.time()
+        encoder = SequenceEncoder(tokenizer, args.block_size)
+        input_ids = np.empty((len(data), args.block_size), dtype=np.int32)
+        for begin in tqdm(range(0, len(data), 1024)):
+            encoder.encode_into([d["func"] for d in data[begin:begin + 1024]],
+                                input_ids[begin:begin + 1024])
+        logger.info("Tokenized %d examples at %.1f examples/s",
+                    len(data), len(data) / max(time.time() - start, 1e-9))
+
+        if "train" in postfix:
+            labels = [d["pred"] for d in data]
+            soft_labels = [d["soft_label"] for d in data]
+        else:
+            labels = [d["target"] for d in data]
+            soft_labels = [[0.1, 0.1]] * len(data)
+        features = {
+            "input_ids": input_ids,
+            "lengths": (input_ids != encoder.pad).sum(1).astype(np.int32),
+            "label": np.array(labels, dtype=np.int64),
+            "pred": np.array(labels if "train" in postfix else [0] * len(data), dtype=np.int64),
+            "soft_label": np.array(soft_labels, dtype=np.float32).reshape(-1, 2)
+        }
+        cache_dir = feature_cache_dir(folder, postfix, inputs, vocab_size, args.block_size)
+        save_features(cache_dir, features)
+        logger.info("Saving features to cache %s", cache_dir)
+        self.set_features(load_features(cache_dir))
+
+    def set_features(self, features):
+        self.input_ids = features["input_ids"]
+        self.lengths = features["lengths"]
+        self.label = features["label"]
+        self.pred = features["pred"]
+        self.soft_label = features["soft_label"]
 
     def __len__(self):
-        return len(self.examples)
+        return len(self.label)
 
     def __getitem__(self, i):
-        return torch.tensor(self.examples[i].input_ids), torch.tensor(self.examples[i].label), torch.tensor(self.examples[i].pred), torch.tensor(self.examples[i].soft_label)
+        return torch.from_numpy(self.input_ids[i]), torch.tensor(self.label[i]), torch.tensor(self.pred[i]), torch.from_numpy(self.soft_label[i])
+
+
+class StreamingDistilledDataset(IterableDataset):
+    """Streaming counterpart of DistilledDataset for corpora larger than RAM.
+    The JSONL file is read lazily and tokenized chunk_size lines at a time;
+    examples are sharded round-robin across DataLoader workers in blocks of
+    batch_size, so every worker but the one holding the last block yields
+    only full batches and the DataLoader length stays exact. A bounded buffer
+    of shuffle_buffer examples gives an approximate shuffle (0 keeps file
+    order). Items match DistilledDataset."""
+
+    def __init__(self, args, vocab_size, file_path, logger, shuffle_buffer=0, chunk_size=1024, batch_size=1):
+        self.file_path = file_path
+        self.shuffle_buffer = shuffle_buffer
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.is_train = "train" in file_path.split("/")[-1].split(".")[0]
+        folder = "/".join(file_path.split("/")[:-1])
+        tokenizer_path = os.path.join(
+            folder, "BPE" + "_" + str(vocab_size) + ".json")
+
+        if os.path.exists(tokenizer_path):
+            tokenizer = Tokenizer.from_file(tokenizer_path)
+            logger.info("Loading vocabulary from file %s", tokenizer_path)
+        else:
+            texts = (" ".join(d["func"].split()) for d in self.read())
+            tokenizer = BPE(texts, vocab_size, file_path, logger)
+        self.encoder = SequenceEncoder(tokenizer, args.block_size)
+
+        with open(file_path) as f:
+            self.n_examples = sum(1 for line in f if line.strip())
+        logger.info("Streaming %d examples from file at %s", self.n_examples, file_path)
+
+    def __len__(self):
+        return self.n_examples
+
+    def read(self, shard=0, n_shards=1):
+        with open(self.file_path) as f:
+            lines = (line for line in f if line.strip())
+            for i, line in enumerate(lines):
+                if i // self.batch_size % n_shards == shard:
+                    yield json.loads(line)
+
+    def examples(self, shard, n_shards):
+        chunk = []
+        for d in self.read(shard, n_shards):
+            chunk.append(d)
+            if len(chunk) == self.chunk_size:
+                yield from self.encode(chunk)
+                chunk = []
+        if chunk:
+            yield from self.encode(chunk)
+
+    def encode(self, chunk):
+        input_ids = self.encoder.encode([d["func"] for d in chunk])
+        for d, ids in zip(chunk, input_ids):
+            if self.is_train:
+                label, pred, soft_label = d["pred"], d["pred"], d["soft_label"]
+            else:
+                label, pred, soft_label = d["target"], 0, [0.1, 0.1]
+            # copy the row out so a buffered example does not pin its whole chunk
+            yield torch.from_numpy(ids.copy()), torch.tensor(label), torch.tensor(pred), torch.tensor(soft_label, dtype=torch.float32)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        if worker is None:
+            shard, n_shards = 0, 1
+            seed = int(torch.randint(1 << 62, ()).item())
+        else:
+            # worker seeds are drawn afresh by the DataLoader every epoch
+            shard, n_shards, seed = worker.id, worker.num_workers, worker.seed
+        examples = self.examples(shard, n_shards)
+        if self.shuffle_buffer <= 0:
+            yield from examples
+            return
+
+        rng = random.Random(seed)
+        buffer = []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = example
+        rng.shuffle(buffer)
+        yield from buffer
 
 
 def set_seed(seed=42):
@@ -88,21 +210,6 @@ def set_seed(seed=42):
     torch.backends.cudnn.deterministic = True
 
 
-class InputFeatures(object):
-    def __init__(self,
-                 input_tokens,
-                 input_ids,
-                 label,
-                 pred=0,
-                 soft_label=[0.1, 0.1]
-                 ):
-        self.input_tokens = input_tokens
-        self.input_ids = input_ids
-        self.label = label
-        self.pred = pred
-        self.soft_label = soft_label
-
-
 # deprecated this class
 class Token_Encoder(object):
     def __init__(self, vocab_size, encoding, file_path, logger):
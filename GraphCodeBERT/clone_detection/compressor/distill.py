@@ -1,7 +1,9 @@
 from __future__ import absolute_import, division, print_function
 
 import os
+import sys
 import json
+import time
 import torch
 import random
 import logging
@@ -11,11 +13,16 @@ import multiprocessing
 import torch.nn.functional as F
 import csv
 
+sys.path.append("../../../parser")
+
 from tqdm import tqdm
 from tokenizers import Tokenizer
 from model import Model, distill_loss
+from dfg_cache import DFGCache
 from tree_sitter import Language, Parser
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler
+from torch.utils.data.dataloader import default_collate
 
 from parser import DFG_python,DFG_java,DFG_ruby,DFG_go,DFG_php,DFG_javascript
 from parser import (remove_comments_and_docstrings,
@@ -125,57 +132,139 @@ class InputFeatures(object):
         self.soft_label = soft_label
         
 
-def convert_examples_to_features(item):
-    #source
-    url1,url2,label,tokenizer, args,cache,url_to_code, s=item
-    parser=parsers["java"]
-    
-    for url in [url1,url2]:
-        if url not in cache:
-            func=url_to_code[url]
-            
-            #extract data flow
-            code_tokens,dfg=extract_dataflow(func,parser,"java")
-            code_tokens=[tokenizer.encode(x).tokens for idx,x in enumerate(code_tokens)]
-            ori2cur_pos={}
-            ori2cur_pos[-1]=(0,0)
-            for i in range(len(code_tokens)):
-                ori2cur_pos[i]=(ori2cur_pos[i-1][1],ori2cur_pos[i-1][1]+len(code_tokens[i]))    
-            code_tokens=[y for x in code_tokens for y in x]  
-            
-            #truncating
-            code_tokens=code_tokens[:args.code_length+args.data_flow_length-3-min(len(dfg),args.data_flow_length)][:512-3]
-            source_tokens =["<s>"]+code_tokens+["</s>"]
-            source_ids =  [tokenizer.token_to_id(tok) for tok in source_tokens]
-            position_idx = [i+tokenizer.token_to_id("<pad>") + 1 for i in range(len(source_tokens))]
-            dfg=dfg[:args.code_length+args.data_flow_length-len(source_tokens)]
-            source_tokens+=[x[0] for x in dfg]
-            position_idx+=[0 for x in dfg]
-            source_ids+=[tokenizer.token_to_id("<unk>") for x in dfg]
-            padding_length=args.code_length+args.data_flow_length-len(source_ids)
-            position_idx+=[tokenizer.token_to_id("<pad>")]*padding_length
-            source_ids+=[tokenizer.token_to_id("<pad>")]*padding_length      
-            
-            #reindex
-            reverse_index={}
-            for idx,x in enumerate(dfg):
-                reverse_index[x[1]]=idx
-            for idx,x in enumerate(dfg):
-                dfg[idx]=x[:-1]+([reverse_index[i] for i in x[-1] if i in reverse_index],)    
-            dfg_to_dfg=[x[-1] for x in dfg]
-            dfg_to_code=[ori2cur_pos[x[1]] for x in dfg]
-            length=len(["<s>"])
-            dfg_to_code=[(x[0]+length,x[1]+length) for x in dfg_to_code]        
-            cache[url]=source_tokens,source_ids,position_idx,dfg_to_code,dfg_to_dfg
+_worker_url_to_code = None
+_worker_tokenizer = None
+_worker_args = None
+_worker_dfg_cache = None
 
-        
-    source_tokens_1,source_ids_1,position_idx_1,dfg_to_code_1,dfg_to_dfg_1=cache[url1]   
-    source_tokens_2,source_ids_2,position_idx_2,dfg_to_code_2,dfg_to_dfg_2=cache[url2]   
-    return InputFeatures(source_tokens_1,source_ids_1,position_idx_1,dfg_to_code_1,dfg_to_dfg_1,
-                   source_tokens_2,source_ids_2,position_idx_2,dfg_to_code_2,dfg_to_dfg_2,
-                     label,url1,url2, s)
+
+def init_worker(url_to_code, tokenizer, args, dfg_cache):
+    global _worker_url_to_code, _worker_tokenizer, _worker_args, _worker_dfg_cache
+    _worker_url_to_code = url_to_code
+    _worker_tokenizer = tokenizer
+    _worker_args = args
+    _worker_dfg_cache = dfg_cache
 
 
+def convert_function_to_features(url):
+    """Pool task: parses one function and returns its source_tokens, source_ids,
+    position_idx, dfg_to_code and dfg_to_dfg."""
+    tokenizer,args=_worker_tokenizer,_worker_args
+    parser=parsers["java"]
+    func=_worker_url_to_code[url]
+
+    #extract data flow, or read it back from the cache
+    code_tokens,dfg=_worker_dfg_cache.load(func,"java",lambda code: extract_dataflow(code,parser,"java"))
+    code_tokens=[tokenizer.encode(x).tokens for idx,x in enumerate(code_tokens)]
+    ori2cur_pos={}
+    ori2cur_pos[-1]=(0,0)
+    for i in range(len(code_tokens)):
+        ori2cur_pos[i]=(ori2cur_pos[i-1][1],ori2cur_pos[i-1][1]+len(code_tokens[i]))    
+    code_tokens=[y for x in code_tokens for y in x]  
+
+    #truncating
+    code_tokens=code_tokens[:args.code_length+args.data_flow_length-3-min(len(dfg),args.data_flow_length)][:512-3]
+    source_tokens =["<s>"]+code_tokens+["</s>"]
+    source_ids =  [tokenizer.token_to_id(tok) for tok in source_tokens]
+    position_idx = [i+tokenizer.token_to_id("<pad>") + 1 for i in range(len(source_tokens))]
+    dfg=dfg[:args.code_length+args.data_flow_length-len(source_tokens)]
+    source_tokens+=[x[0] for x in dfg]
+    position_idx+=[0 for x in dfg]
+    source_ids+=[tokenizer.token_to_id("<unk>") for x in dfg]
+    padding_length=args.code_length+args.data_flow_length-len(source_ids)
+    position_idx+=[tokenizer.token_to_id("<pad>")]*padding_length
+    source_ids+=[tokenizer.token_to_id("<pad>")]*padding_length      
+
+    #reindex
+    reverse_index={}
+    for idx,x in enumerate(dfg):
+        reverse_index[x[1]]=idx
+    for idx,x in enumerate(dfg):
+        dfg[idx]=x[:-1]+([reverse_index[i] for i in x[-1] if i in reverse_index],)    
+    dfg_to_dfg=[x[-1] for x in dfg]
+    dfg_to_code=[ori2cur_pos[x[1]] for x in dfg]
+    length=len(["<s>"])
+    dfg_to_code=[(x[0]+length,x[1]+length) for x in dfg_to_code]        
+    return source_tokens,source_ids,position_idx,dfg_to_code,dfg_to_dfg
+
+
+def graph_inputs(dfg_to_code, dfg_to_dfg):
+    """Compact data-flow inputs of one example's graph-guided attention mask,
+    computed once at dataset construction: the [n_nodes, 2] code span of each
+    node and the [n_edges, 2] (node, node) edges."""
+    spans = np.array(dfg_to_code, dtype=np.int64).reshape(-1, 2)
+    edges = np.array([(idx, a) for idx, nodes in enumerate(dfg_to_dfg) for a in nodes],
+                     dtype=np.int64).reshape(-1, 2)
+    return spans, edges
+
+
+def reference_attention_mask(input_ids, position_idx, dfg_to_code, dfg_to_dfg):
+    """Graph-guided attention mask of one function, built with the per-item
+    loops TextDataset.__getitem__ used before collate_batch; kept as the
+    reference benchmark_collate measures and checks graph_attention_masks
+    against."""
+    attn_mask=np.zeros((len(position_idx),len(position_idx)),dtype=bool)
+    #calculate begin index of node and max length of input
+    node_index=sum([i>1 for i in position_idx])
+    max_length=sum([i!=1 for i in position_idx])
+    #sequence can attend to sequence
+    attn_mask[:node_index,:node_index]=True
+    #special tokens attend to all tokens
+    for idx,i in enumerate(input_ids):
+        if i in [0,2]:
+            attn_mask[idx,:max_length]=True
+    #nodes attend to code tokens that are identified from
+    for idx,(a,b) in enumerate(dfg_to_code):
+        if a<node_index and b<node_index:
+            attn_mask[idx+node_index,a:b]=True
+            attn_mask[a:b,idx+node_index]=True
+    #nodes attend to adjacent nodes
+    for idx,nodes in enumerate(dfg_to_dfg):
+        for a in nodes:
+            if a+node_index<len(position_idx):
+                attn_mask[idx+node_index,a+node_index]=True
+    return attn_mask
+
+
+def graph_attention_masks(input_ids, position_idx, spans, edges):
+    """Graph-guided attention masks of a whole batch, built with broadcasting
+    and scatter. input_ids and position_idx are [B, L]; spans is the [B, N, 2]
+    code span of each data-flow node, padded with empty (0, 0) spans; edges is
+    the [B, E, 2] (node, node) edges, padded with -1. Returns [B, L, L] bools."""
+    length = position_idx.shape[1]
+    # int16 positions keep the [B, L, L] comparison below cheap
+    positions = np.arange(length, dtype=np.int16)
+    node_index = (position_idx > 1).sum(1, dtype=np.int16)[:, None]
+    max_length = (position_idx != 1).sum(1, dtype=np.int16)[:, None]
+    # each row first attends to a prefix of the input: code tokens to the
+    # code, special tokens to all tokens, nodes and padding to nothing
+    limit = np.where(positions < node_index, node_index, np.int16(0))
+    limit = np.where((input_ids == 0) | (input_ids == 2), np.maximum(limit, max_length), limit)
+    attn_mask = positions < limit[:, :, None]
+    # nodes attend to code tokens that are identified from, and back
+    batch, node = np.nonzero((spans[..., 0] < node_index) & (spans[..., 1] < node_index))
+    start, end = spans[batch, node, 0], spans[batch, node, 1]
+    widths = np.maximum(end-start, 0)
+    batch = np.repeat(batch, widths)
+    node = np.repeat(node, widths)+node_index[batch, 0]
+    token = np.arange(widths.sum())+np.repeat(start-np.cumsum(widths)+widths, widths)
+    attn_mask[batch, node, token] = True
+    attn_mask[batch, token, node] = True
+    # nodes attend to adjacent nodes
+    batch, edge = np.nonzero((edges[..., 0] >= 0) & (edges[..., 1]+node_index < length))
+    offset = node_index[batch, 0]
+    attn_mask[batch, edges[batch, edge, 0]+offset, edges[batch, edge, 1]+offset] = True
+    return attn_mask
+
+def collate_graph_inputs(input_ids, position_idx, spans, edges):
+    """Stacks per-example graph inputs and builds their attention masks. The
+    padded [B, N, 2] spans are returned too, for the node embedding average."""
+    input_ids, position_idx = torch.stack(input_ids), torch.stack(position_idx)
+    spans = pad_sequence(spans, batch_first=True)
+    attn_mask = graph_attention_masks(input_ids.numpy(), position_idx.numpy(), spans.numpy(),
+                                      pad_sequence(edges, batch_first=True, padding_value=-1).numpy())
+    return input_ids, position_idx, torch.from_numpy(attn_mask), spans
+
 class TextDataset(Dataset):
     def __init__(self, tokenizer, args, file_path="train"):
         postfix=file_path.split("/")[-1].split(".txt")[0]
@@ -200,7 +289,6 @@ class TextDataset(Dataset):
                 
         #load code function according to index
         data=[]
-        cache={}
         f=open(index_filename)
         with open(index_filename) as f:
             for line in f:
@@ -216,23 +304,26 @@ class TextDataset(Dataset):
                     label=0
                 else:
                     label=1
-                data.append((url1,url2,label,tokenizer, args,cache,url_to_code))
+                data.append((url1,url2,label))
         if "train" in postfix:
             soft_labels = np.load(os.path.join(folder, "preds_unlabel_train_gcb.npy")).tolist()
-        
-        _mp_data = []
-        for i, d in enumerate(data):
-            lst = list(d)
-            # lst.append(tokenizer)
-            if "train" in postfix:
-                lst.append(soft_labels[i])
-            else:
-                lst.append([0.1, 0.1])
-            _mp_data.append(tuple(lst))
-
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        self.examples = pool.map(convert_examples_to_features, tqdm(_mp_data, total=len(_mp_data)))    
-
+        else:
+            soft_labels = [[0.1, 0.1]]*len(data)
+
+        #parse each unique function once across the pool, then assemble the pairs
+        urls=list(dict.fromkeys(url for d in data for url in d[:2]))
+        logger.info("%d unique functions for %d pairs", len(urls), len(data))
+        dfg_cache=DFGCache(os.path.join(folder, "dfg_cache"))
+        logger.info("Reading data flow from cache %s", dfg_cache.cache_dir)
+        pool = multiprocessing.Pool(multiprocessing.cpu_count(), initializer=init_worker,
+                                    initargs=(url_to_code, tokenizer, args, dfg_cache))
+        functions = dict(zip(urls, tqdm(pool.imap(convert_function_to_features, urls, chunksize=64), total=len(urls))))
+        pool.close()
+        pool.join()
+        self.examples = [InputFeatures(*functions[url1], *functions[url2], label, url1, url2, soft_labels[i])
+                         for i, (url1, url2, label) in enumerate(data)]
+        graphs = {url: graph_inputs(x[3], x[4]) for url, x in functions.items()}
+        self.graph_inputs = [(graphs[x.url1], graphs[x.url2]) for x in self.examples]
         if "train" in file_path:
             for idx, example in enumerate(self.examples[:3]):
                 logger.info("*** Example ***")
@@ -256,62 +347,56 @@ class TextDataset(Dataset):
         return len(self.examples)
     
     def __getitem__(self, item):
-        #calculate graph-guided masked function
-        attn_mask_1= np.zeros((self.args.code_length+self.args.data_flow_length,
-                        self.args.code_length+self.args.data_flow_length),dtype=bool)
-        #calculate begin index of node and max length of input
-        node_index=sum([i>1 for i in self.examples[item].position_idx_1])
-        max_length=sum([i!=1 for i in self.examples[item].position_idx_1])
-        #sequence can attend to sequence
-        attn_mask_1[:node_index,:node_index]=True
-        #special tokens attend to all tokens
-        for idx,i in enumerate(self.examples[item].input_ids_1):
-            if i in [0,2]:
-                attn_mask_1[idx,:max_length]=True
-        #nodes attend to code tokens that are identified from
-        for idx,(a,b) in enumerate(self.examples[item].dfg_to_code_1):
-            if a<node_index and b<node_index:
-                attn_mask_1[idx+node_index,a:b]=True
-                attn_mask_1[a:b,idx+node_index]=True
-        #nodes attend to adjacent nodes 
-        for idx,nodes in enumerate(self.examples[item].dfg_to_dfg_1):
-            for a in nodes:
-                if a+node_index<len(self.examples[item].position_idx_1):
-                    attn_mask_1[idx+node_index,a+node_index]=True  
-                    
-        #calculate graph-guided masked function
-        attn_mask_2= np.zeros((self.args.code_length+self.args.data_flow_length,
-                        self.args.code_length+self.args.data_flow_length),dtype=bool)
-        #calculate begin index of node and max length of input
-        node_index=sum([i>1 for i in self.examples[item].position_idx_2])
-        max_length=sum([i!=1 for i in self.examples[item].position_idx_2])
-        #sequence can attend to sequence
-        attn_mask_2[:node_index,:node_index]=True
-        #special tokens attend to all tokens
-        for idx,i in enumerate(self.examples[item].input_ids_2):
-            if i in [0,2]:
-                attn_mask_2[idx,:max_length]=True
-        #nodes attend to code tokens that are identified from
-        for idx,(a,b) in enumerate(self.examples[item].dfg_to_code_2):
-            if a<node_index and b<node_index:
-                attn_mask_2[idx+node_index,a:b]=True
-                attn_mask_2[a:b,idx+node_index]=True
-        #nodes attend to adjacent nodes 
-        for idx,nodes in enumerate(self.examples[item].dfg_to_dfg_2):
-            for a in nodes:
-                if a+node_index<len(self.examples[item].position_idx_2):
-                    attn_mask_2[idx+node_index,a+node_index]=True                      
-                    
+        #the attention masks are built for the whole batch by collate_batch
+        (spans_1,edges_1),(spans_2,edges_2)=self.graph_inputs[item]
         return (torch.tensor(self.examples[item].input_ids_1),
                 torch.tensor(self.examples[item].position_idx_1),
-                torch.tensor(attn_mask_1), 
+                torch.from_numpy(spans_1),
+                torch.from_numpy(edges_1),
                 torch.tensor(self.examples[item].input_ids_2),
                 torch.tensor(self.examples[item].position_idx_2),
-                torch.tensor(attn_mask_2),                 
+                torch.from_numpy(spans_2),
+                torch.from_numpy(edges_2),
                 torch.tensor(self.examples[item].label),
                 torch.tensor(self.examples[item].soft_label))
 
 
+def collate_batch(batch):
+    """Collates TextDataset items, building the attention masks of both
+    functions for the whole batch at once. The padded spans of both functions
+    come last."""
+    columns = list(zip(*batch))
+    input_ids_1, position_idx_1, attn_mask_1, spans_1 = collate_graph_inputs(*columns[0:4])
+    input_ids_2, position_idx_2, attn_mask_2, spans_2 = collate_graph_inputs(*columns[4:8])
+    return (input_ids_1, position_idx_1, attn_mask_1, input_ids_2, position_idx_2, attn_mask_2,
+            torch.stack(columns[8]), torch.stack(columns[9]), spans_1, spans_2)
+
+
+def benchmark_collate(dataset, batch_size, n_batches=20):
+    """Times batches built item by item with the original per-item mask loops
+    (reference_attention_mask) against TextDataset items collated by
+    collate_batch, and checks that both give the same batches."""
+    batches = [range(start, min(start+batch_size, len(dataset)))
+               for start in range(0, min(len(dataset), n_batches*batch_size), batch_size)]
+
+    def reference_item(x):
+        attn_mask_1 = reference_attention_mask(x.input_ids_1, x.position_idx_1, x.dfg_to_code_1, x.dfg_to_dfg_1)
+        attn_mask_2 = reference_attention_mask(x.input_ids_2, x.position_idx_2, x.dfg_to_code_2, x.dfg_to_dfg_2)
+        return (torch.tensor(x.input_ids_1), torch.tensor(x.position_idx_1), torch.tensor(attn_mask_1),
+                torch.tensor(x.input_ids_2), torch.tensor(x.position_idx_2), torch.tensor(attn_mask_2),
+                torch.tensor(x.label), torch.tensor(x.soft_label))
+
+    start = time.time()
+    reference = [default_collate([reference_item(dataset.examples[i]) for i in batch]) for batch in batches]
+    reference_time = (time.time()-start)/len(batches)
+    start = time.time()
+    batched = [collate_batch([dataset[i] for i in batch]) for batch in batches]
+    batched_time = (time.time()-start)/len(batches)
+    for a, b in zip(reference, batched):
+        assert all(torch.equal(x, y) for x, y in zip(a, b[:len(a)]))
+    logger.info("Attention masks per batch of %d: %.2f ms with the per-item loops, %.2f ms batched",
+                batch_size, reference_time*1e3, batched_time*1e3)
+
 def set_seed(args):
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -320,12 +405,12 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 
-def train(args, train_dataset, model, tokenizer):
+def train(args, train_dataset, model, tokenizer, eval_dataloader):
     """ Train the model """
     
     #build dataloader
     train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size,num_workers=4)
+    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size,num_workers=4,collate_fn=collate_batch)
     
     args.max_steps=args.epochs*len( train_dataloader)
     args.save_steps=len(train_dataloader)
@@ -369,9 +454,9 @@ def train(args, train_dataset, model, tokenizer):
         for step, batch in enumerate(bar):
             (inputs_ids_1,position_idx_1,attn_mask_1,
             inputs_ids_2,position_idx_2,attn_mask_2,
-            labels, soft_knowledge)=[x.to(args.device)  for x in batch]
+            labels, soft_knowledge, spans_1, spans_2)=[x.to(args.device)  for x in batch]
             model.train()
-            _,logits = model(inputs_ids_1,position_idx_1,attn_mask_1,inputs_ids_2,position_idx_2,attn_mask_2,labels)
+            _,logits = model(inputs_ids_1,position_idx_1,attn_mask_1,inputs_ids_2,position_idx_2,attn_mask_2,spans_1,spans_2,labels)
             loss = distill_loss(logits, soft_knowledge)
             if args.n_gpu > 1:
                 loss = loss.mean()
@@ -399,7 +484,7 @@ def train(args, train_dataset, model, tokenizer):
                 avg_loss=round(np.exp((tr_loss - logging_loss) /(global_step- tr_nb)),4)
 
                 if global_step % args.save_steps == 0:
-                    results = evaluate(args, model, tokenizer, eval_when_training=True)    
+                    results = evaluate(args, model, tokenizer, eval_dataloader, eval_when_training=True)    
                     
                     # Save model checkpoint
                     if results["eval_acc"]>best_f1:
@@ -417,11 +502,17 @@ def train(args, train_dataset, model, tokenizer):
                         torch.save(model_to_save.state_dict(), output_dir)
                         logger.info("Saving model checkpoint to %s", output_dir)
                         
-def evaluate(args, model, tokenizer, eval_when_training=False):
-    #build dataloader
-    eval_dataset = TextDataset(tokenizer, args, file_path=args.eval_data_file)
+def build_eval_dataloader(args, tokenizer, file_path):
+    """Builds the dataset and dataloader of an eval or test file once, so that
+    evaluations during training only run inference."""
+    start = time.time()
+    eval_dataset = TextDataset(tokenizer, args, file_path=file_path)
+    logger.info("Built %d examples from %s in %.1fs", len(eval_dataset), file_path, time.time()-start)
     eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler,batch_size=args.eval_batch_size,num_workers=4)
+    return DataLoader(eval_dataset, sampler=eval_sampler,batch_size=args.eval_batch_size,num_workers=4,collate_fn=collate_batch)
+
+
+def evaluate(args, model, tokenizer, eval_dataloader, eval_when_training=False):
 
     # multi-gpu evaluate
     if args.n_gpu > 1 and eval_when_training is False:
@@ -429,7 +520,7 @@ def evaluate(args, model, tokenizer, eval_when_training=False):
 
     # Eval!
     logger.info("***** Running evaluation *****")
-    logger.info("  Num examples = %d", len(eval_dataset))
+    logger.info("  Num examples = %d", len(eval_dataloader.dataset))
     logger.info("  Batch size = %d", args.eval_batch_size)
     
     eval_loss = 0.0
@@ -440,9 +531,9 @@ def evaluate(args, model, tokenizer, eval_when_training=False):
     for batch in tqdm(eval_dataloader):
         (inputs_ids_1,position_idx_1,attn_mask_1,
         inputs_ids_2,position_idx_2,attn_mask_2,
-        labels, soft_label)=[x.to(args.device)  for x in batch]
+        labels, soft_label, spans_1, spans_2)=[x.to(args.device)  for x in batch]
         with torch.no_grad():
-            lm_loss,logit = model(inputs_ids_1,position_idx_1,attn_mask_1,inputs_ids_2,position_idx_2,attn_mask_2,labels)
+            lm_loss,logit = model(inputs_ids_1,position_idx_1,attn_mask_1,inputs_ids_2,position_idx_2,attn_mask_2,spans_1,spans_2,labels)
             eval_loss += lm_loss.mean().item()
             logit = F.softmax(logit)
             logits.append(logit.cpu().numpy())
@@ -476,11 +567,7 @@ def evaluate(args, model, tokenizer, eval_when_training=False):
 
     return result
 
-def test(args, model, tokenizer, best_threshold=0):
-    #build dataloader
-    eval_dataset = TextDataset(tokenizer, args, file_path=args.test_data_file)
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,num_workers=4)
+def test(args, model, tokenizer, eval_dataloader, best_threshold=0):
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -488,7 +575,7 @@ def test(args, model, tokenizer, best_threshold=0):
 
     # Eval!
     logger.info("***** Running Test *****")
-    logger.info("  Num examples = %d", len(eval_dataset))
+    logger.info("  Num examples = %d", len(eval_dataloader.dataset))
     logger.info("  Batch size = %d", args.eval_batch_size)
     eval_loss = 0.0
     nb_eval_steps = 0
@@ -498,9 +585,9 @@ def test(args, model, tokenizer, best_threshold=0):
     for batch in tqdm(eval_dataloader):
         (inputs_ids_1,position_idx_1,attn_mask_1,
         inputs_ids_2,position_idx_2,attn_mask_2,
-        labels, soft_label)=[x.to(args.device)  for x in batch]
+        labels, soft_label, spans_1, spans_2)=[x.to(args.device)  for x in batch]
         with torch.no_grad():
-            lm_loss,logit = model(inputs_ids_1,position_idx_1,attn_mask_1,inputs_ids_2,position_idx_2,attn_mask_2,labels)
+            lm_loss,logit = model(inputs_ids_1,position_idx_1,attn_mask_1,inputs_ids_2,position_idx_2,attn_mask_2,spans_1,spans_2,labels)
             logit = F.softmax(logit)
             eval_loss += lm_loss.mean().item()
             logits.append(logit.cpu().numpy())
@@ -568,6 +655,8 @@ def main():
                         help="Whether to run eval on the dev set.")    
     parser.add_argument("--evaluate_during_training", action="store_true",
                         help="Run evaluation during training at each logging step.")
+    parser.add_argument("--benchmark_collate", action="store_true",
+                        help="Time batched attention-mask collation against per-item masks on the dev set.")
 
     parser.add_argument("--train_batch_size", default=4, type=int,
                         help="Batch size per GPU/CPU for training.")
@@ -650,10 +739,15 @@ def main():
     model = Model(RobertaForSequenceClassification(config=config),config,tokenizer,args)   
 
     logger.info("Training/evaluation parameters %s", args)
+    if args.do_train or args.do_eval or args.benchmark_collate:
+        eval_dataloader = build_eval_dataloader(args, tokenizer, args.eval_data_file)
+    if args.benchmark_collate:
+        benchmark_collate(eval_dataloader.dataset, args.eval_batch_size)
+
     # Training
     if args.do_train:
         train_dataset = TextDataset(tokenizer, args, file_path=args.train_data_file)
-        train(args, train_dataset, model, tokenizer)
+        train(args, train_dataset, model, tokenizer, eval_dataloader)
 
     # Evaluation
     results = {}
@@ -662,14 +756,15 @@ def main():
         output_dir = os.path.join(args.output_dir, "{}".format(checkpoint_prefix), args.size, "model.bin")  
         model.load_state_dict(torch.load(output_dir))
         model.to(args.device)
-        results = evaluate(args, model, tokenizer)
+        results = evaluate(args, model, tokenizer, eval_dataloader)
         
     if args.do_test:
         checkpoint_prefix = ""
         output_dir = os.path.join(args.output_dir, "{}".format(checkpoint_prefix), args.size, "model.bin")  
         model.load_state_dict(torch.load(output_dir))
         model.to(args.device)
-        results = test(args, model, tokenizer,best_threshold=0.5)
+        test_dataloader = build_eval_dataloader(args, tokenizer, args.test_data_file)
+        results = test(args, model, tokenizer, test_dataloader, best_threshold=0.5)
 
         # --- CSV Saving Logic ---
         csv_file_exists = os.path.exists(args.result_csv_path)
@@ -4,6 +4,7 @@ import argparse
 import glob
 import logging
 import os
+import sys
 import pickle
 import random
 import re
@@ -18,6 +19,8 @@ from transformers import (WEIGHTS_NAME, AdamW, get_linear_schedule_with_warmup,
 from tqdm import tqdm, trange
 import multiprocessing
 from model import Model
+sys.path.append('../../../parser')
+from dfg_cache import DFGCache
 
 cpu_cont = 16
 logger = logging.getLogger(__name__)
@@ -126,15 +129,15 @@ class InputFeatures(object):
 
 def convert_examples_to_features(item):
     #source
-    url1,url2,label,tokenizer, args,cache,url_to_code=item
+    url1,url2,label,tokenizer, args,cache,url_to_code,dfg_cache=item
     parser=parsers['java']
     
     for url in [url1,url2]:
         if url not in cache:
             func=url_to_code[url]
             
-            #extract data flow
-            code_tokens,dfg=extract_dataflow(func,parser,'java')
+            #extract data flow, or read it back from the cache
+            code_tokens,dfg=dfg_cache.load(func,'java',lambda code: extract_dataflow(code,parser,'java'))
             code_tokens=[tokenizer.tokenize('@ '+x)[1:] if idx!=0 else tokenizer.tokenize(x) for idx,x in enumerate(code_tokens)]
             ori2cur_pos={}
             ori2cur_pos[-1]=(0,0)
@@ -208,6 +211,8 @@ class TextDataset(Dataset):
         #load code function according to index
         data=[]
         cache={}
+        dfg_cache=DFGCache(os.path.join(folder, 'dfg_cache'))
+        logger.info("Reading data flow from cache %s", dfg_cache.cache_dir)
         f=open(index_filename)
         with open(index_filename) as f:
             for line in f:
@@ -223,7 +228,7 @@ class TextDataset(Dataset):
                     label=0
                 else:
                     label=1
-                data.append((url1,url2,label,tokenizer, args,cache,url_to_code))
+                data.append((url1,url2,label,tokenizer, args,cache,url_to_code,dfg_cache))
         # data = data[:100]
         #only use 10% valid data to keep best model        
         # if 'valid' in file_path:
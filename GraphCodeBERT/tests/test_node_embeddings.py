@@ -0,0 +1,66 @@
+import os
+import importlib.util
+
+import numpy as np
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_model(task):
+    spec = importlib.util.spec_from_file_location(
+        task + "_model", os.path.join(ROOT, task, "compressor", "model.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def dense_average(inputs_embeddings, position_idx, spans):
+    """The einsum node embedding average of the original Model.forward, over the
+    node-to-code part of the graph-guided attention mask."""
+    bs, l, _ = inputs_embeddings.size()
+    attn_mask = torch.zeros(bs, l, l, dtype=torch.bool)
+    for i in range(bs):
+        node_index = int(position_idx[i].gt(1).sum())
+        n_nodes = int(position_idx[i].eq(0).sum())
+        for idx, (a, b) in enumerate(spans[i, :n_nodes].tolist()):
+            if a < node_index and b < node_index:
+                attn_mask[i, idx+node_index, a:b] = True
+    nodes_mask = position_idx.eq(0)
+    token_mask = position_idx.ge(2)
+    nodes_to_token_mask = nodes_mask[:, :, None] & token_mask[:, None, :] & attn_mask
+    nodes_to_token_mask = nodes_to_token_mask/(nodes_to_token_mask.sum(-1)+1e-10)[:, :, None]
+    avg_embeddings = torch.einsum("abc,acd->abd", nodes_to_token_mask, inputs_embeddings)
+    return inputs_embeddings*(~nodes_mask)[:, :, None]+avg_embeddings*nodes_mask[:, :, None]
+
+
+def batch_inputs(lengths, l, rng):
+    """position_idx and spans padded with (0, 0) for (n_code, n_nodes) examples,
+    with some spans reaching past the code."""
+    position_idx = torch.ones(len(lengths), l, dtype=torch.int64)
+    spans = torch.zeros(len(lengths), max(n for _, n in lengths), 2, dtype=torch.int64)
+    for i, (n_code, n_nodes) in enumerate(lengths):
+        position_idx[i, :n_code] = torch.arange(n_code)+2
+        position_idx[i, n_code:n_code+n_nodes] = 0
+        start = rng.randint(1, n_code+5, n_nodes)
+        spans[i, :n_nodes, 0] = torch.from_numpy(start)
+        spans[i, :n_nodes, 1] = torch.from_numpy(start+rng.randint(0, 4, n_nodes))
+    return position_idx, spans
+
+
+@pytest.mark.parametrize("task", ["clone_detection", "vulnerability_prediction"])
+def test_matches_dense_average(task):
+    average_node_embeddings = load_model(task).average_node_embeddings
+    rng = np.random.RandomState(0)
+    l = 320
+    cases = [[(100, 60), (300, 10)], [(300, 10), (100, 60)], [(50, 0), (40, 0)]]
+    for _ in range(50):
+        n_nodes = rng.randint(0, 65, 4)
+        cases.append([(rng.randint(3, l-n+1), n) for n in n_nodes])
+    for lengths in cases:
+        position_idx, spans = batch_inputs(lengths, l, rng)
+        inputs_embeddings = torch.randn(len(lengths), l, 8)
+        expected = dense_average(inputs_embeddings, position_idx, spans)
+        actual = average_node_embeddings(inputs_embeddings, position_idx, spans)
+        assert torch.allclose(actual, expected, atol=1e-5), lengths
@@ -3,6 +3,7 @@ from __future__ import absolute_import, division, print_function
 import os
 import sys
 import json
+import time
 import torch
 import random
 import logging
@@ -19,7 +20,10 @@ from tqdm import tqdm
 from tokenizers import Tokenizer
 from model import Model, distill_loss
 from run_parser import extract_dataflow
+from dfg_cache import DFGCache
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.distributed import DistributedSampler
 from transformers import (AdamW, get_linear_schedule_with_warmup,
                           BertConfig, BertForMaskedLM, BertTokenizer,
@@ -64,10 +68,16 @@ class InputFeatures(object):
         self.soft_label = soft_label
 
 
-def convert_examples_to_features(js, tokenizer, args, pred):
+def extract_code_dataflow(code):
+    """Code tokens and data flow of a C function, as stored in the DFG cache."""
+    dfg, _, code_tokens = extract_dataflow(code, "c")
+    return code_tokens, dfg
+
+
+def convert_examples_to_features(js, tokenizer, args, pred, dfg_cache):
     # source
     code = ' '.join(js['func'].split())
-    dfg, index_table, code_tokens = extract_dataflow(code, "c")
+    code_tokens, dfg = dfg_cache.load(code, "c", extract_code_dataflow)
 
     code_tokens = [tokenizer.encode(
         x).tokens for idx, x in enumerate(code_tokens)]
@@ -106,6 +116,102 @@ def convert_examples_to_features(js, tokenizer, args, pred):
     return InputFeatures(source_tokens, source_ids, position_idx, dfg_to_code, dfg_to_dfg, js['idx'], js['target'], pred)
 
 
+_worker_tokenizer = None
+_worker_args = None
+_worker_dfg_cache = None
+
+
+def init_worker(tokenizer, args, dfg_cache):
+    global _worker_tokenizer, _worker_args, _worker_dfg_cache
+    _worker_tokenizer = tokenizer
+    _worker_args = args
+    _worker_dfg_cache = dfg_cache
+
+
+def convert_line_to_features(item):
+    """Pool task: converts one jsonl line with its soft label."""
+    line, pred = item
+    return convert_examples_to_features(
+        json.loads(line.strip()), _worker_tokenizer, _worker_args, pred, _worker_dfg_cache)
+
+
+def graph_inputs(dfg_to_code, dfg_to_dfg):
+    """Compact data-flow inputs of one example's graph-guided attention mask,
+    computed once at dataset construction: the [n_nodes, 2] code span of each
+    node and the [n_edges, 2] (node, node) edges."""
+    spans = np.array(dfg_to_code, dtype=np.int64).reshape(-1, 2)
+    edges = np.array([(idx, a) for idx, nodes in enumerate(dfg_to_dfg) for a in nodes],
+                     dtype=np.int64).reshape(-1, 2)
+    return spans, edges
+
+
+def reference_attention_mask(input_ids, position_idx, dfg_to_code, dfg_to_dfg):
+    """Graph-guided attention mask of one example, built with the per-item
+    loops TextDataset.__getitem__ used before collate_batch; kept as the
+    reference benchmark_collate measures and checks graph_attention_masks
+    against."""
+    attn_mask = np.zeros((len(position_idx), len(position_idx)), dtype=bool)
+    # calculate begin index of node and max length of input
+    node_index = sum([i > 1 for i in position_idx])
+    max_length = sum([i != 1 for i in position_idx])
+    # sequence can attend to sequence
+    attn_mask[:node_index, :node_index] = True
+    # special tokens attend to all tokens
+    for idx, i in enumerate(input_ids):
+        if i in [0, 2]:
+            attn_mask[idx, :max_length] = True
+    # nodes attend to code tokens that are identified from
+    for idx, (a, b) in enumerate(dfg_to_code):
+        if a < node_index and b < node_index:
+            attn_mask[idx+node_index, a:b] = True
+            attn_mask[a:b, idx+node_index] = True
+    # nodes attend to adjacent nodes
+    for idx, nodes in enumerate(dfg_to_dfg):
+        for a in nodes:
+            if a+node_index < len(position_idx):
+                attn_mask[idx+node_index, a+node_index] = True
+    return attn_mask
+
+
+def graph_attention_masks(input_ids, position_idx, spans, edges):
+    """Graph-guided attention masks of a whole batch, built with broadcasting
+    and scatter. input_ids and position_idx are [B, L]; spans is the [B, N, 2]
+    code span of each data-flow node, padded with empty (0, 0) spans; edges is
+    the [B, E, 2] (node, node) edges, padded with -1. Returns [B, L, L] bools."""
+    length = position_idx.shape[1]
+    # int16 positions keep the [B, L, L] comparison below cheap
+    positions = np.arange(length, dtype=np.int16)
+    node_index = (position_idx > 1).sum(1, dtype=np.int16)[:, None]
+    max_length = (position_idx != 1).sum(1, dtype=np.int16)[:, None]
+    # each row first attends to a prefix of the input: code tokens to the
+    # code, special tokens to all tokens, nodes and padding to nothing
+    limit = np.where(positions < node_index, node_index, np.int16(0))
+    limit = np.where((input_ids == 0) | (input_ids == 2), np.maximum(limit, max_length), limit)
+    attn_mask = positions < limit[:, :, None]
+    # nodes attend to code tokens that are identified from, and back
+    batch, node = np.nonzero((spans[..., 0] < node_index) & (spans[..., 1] < node_index))
+    start, end = spans[batch, node, 0], spans[batch, node, 1]
+    widths = np.maximum(end-start, 0)
+    batch = np.repeat(batch, widths)
+    node = np.repeat(node, widths)+node_index[batch, 0]
+    token = np.arange(widths.sum())+np.repeat(start-np.cumsum(widths)+widths, widths)
+    attn_mask[batch, node, token] = True
+    attn_mask[batch, token, node] = True
+    # nodes attend to adjacent nodes
+    batch, edge = np.nonzero((edges[..., 0] >= 0) & (edges[..., 1]+node_index < length))
+    offset = node_index[batch, 0]
+    attn_mask[batch, edges[batch, edge, 0]+offset, edges[batch, edge, 1]+offset] = True
+    return attn_mask
+
+def collate_graph_inputs(input_ids, position_idx, spans, edges):
+    """Stacks per-example graph inputs and builds their attention masks. The
+    padded [B, N, 2] spans are returned too, for the node embedding average."""
+    input_ids, position_idx = torch.stack(input_ids), torch.stack(position_idx)
+    spans = pad_sequence(spans, batch_first=True)
+    attn_mask = graph_attention_masks(input_ids.numpy(), position_idx.numpy(), spans.numpy(),
+                                      pad_sequence(edges, batch_first=True, padding_value=-1).numpy())
+    return input_ids, position_idx, torch.from_numpy(attn_mask), spans
+
 class TextDataset(Dataset):
     def __init__(self, tokenizer, args, file_path=None):
         self.examples = []
@@ -120,16 +226,24 @@ class TextDataset(Dataset):
         tokenizer_path = os.path.join(
             folder, "BPE" + "_" + str(args.vocab_size) + ".json")
         tokenizer = Tokenizer.from_file(tokenizer_path)
-        # cout = 0
+        dfg_cache = DFGCache(os.path.join(folder, "dfg_cache"))
+        logger.info("Reading data flow from cache %s", dfg_cache.cache_dir)
         with open(file_path) as f:
-            for i, line in tqdm(enumerate(f)):
-                js = json.loads(line.strip())
-                if  args.do_train:
-                    self.examples.append(convert_examples_to_features(
-                        js, tokenizer, args, preds[i]))
-                else:
-                    self.examples.append(convert_examples_to_features(
-                        js, tokenizer, args, [0.1, 0.1]))
+            items = [(line, preds[i] if args.do_train else [0.1, 0.1])
+                     for i, line in enumerate(f)]
+
+        # the tokenizer and parsers reach each worker once, through the pool
+        # initializer and the module import, and lines are sent in chunks
+        start = time.time()
+        pool = multiprocessing.Pool(cpu_cont, initializer=init_worker,
+                                    initargs=(tokenizer, args, dfg_cache))
+        self.examples = list(tqdm(pool.imap(convert_line_to_features, items, chunksize=64),
+                                  total=len(items)))
+        pool.close()
+        pool.join()
+        logger.info("Converted %d examples at %.1f examples/s",
+                    len(self.examples), len(self.examples)/(time.time()-start))
+        self.graph_inputs = [graph_inputs(x.dfg_to_code, x.dfg_to_dfg) for x in self.examples]
 
         if 'train' in file_path:
             for idx, example in enumerate(self.examples[:3]):
@@ -146,37 +260,47 @@ class TextDataset(Dataset):
         return len(self.examples)
 
     def __getitem__(self, item):
-        # calculate graph-guided masked function
-        attn_mask = np.zeros((self.args.code_length+self.args.data_flow_length,
-                              self.args.code_length+self.args.data_flow_length), dtype=np.bool)
-        # calculate begin index of node and max length of input
-
-        node_index = sum([i > 1 for i in self.examples[item].position_idx])
-        max_length = sum([i != 1 for i in self.examples[item].position_idx])
-        # sequence can attend to sequence
-        attn_mask[:node_index, :node_index] = True
-        # special tokens attend to all tokens
-        for idx, i in enumerate(self.examples[item].input_ids):
-            if i in [0, 2]:
-                attn_mask[idx, :max_length] = True
-        # nodes attend to code tokens that are identified from
-        for idx, (a, b) in enumerate(self.examples[item].dfg_to_code):
-            if a < node_index and b < node_index:
-                attn_mask[idx+node_index, a:b] = True
-                attn_mask[a:b, idx+node_index] = True
-        # nodes attend to adjacent nodes
-        for idx, nodes in enumerate(self.examples[item].dfg_to_dfg):
-            for a in nodes:
-                if a+node_index < len(self.examples[item].position_idx):
-                    attn_mask[idx+node_index, a+node_index] = True
-
+        # the attention mask is built for the whole batch by collate_batch
+        spans, edges = self.graph_inputs[item]
         return (torch.tensor(self.examples[item].input_ids),
-                torch.tensor(attn_mask),
                 torch.tensor(self.examples[item].position_idx),
+                torch.from_numpy(spans),
+                torch.from_numpy(edges),
                 torch.tensor(self.examples[item].label),
                 torch.tensor(self.examples[item].soft_label))
 
 
+def collate_batch(batch):
+    """Collates TextDataset items, building the attention masks for the whole
+    batch at once. The padded spans come last."""
+    columns = list(zip(*batch))
+    input_ids, position_idx, attn_mask, spans = collate_graph_inputs(*columns[0:4])
+    return input_ids, attn_mask, position_idx, torch.stack(columns[4]), torch.stack(columns[5]), spans
+
+
+def benchmark_collate(dataset, batch_size, n_batches=20):
+    """Times batches built item by item with the original per-item mask loops
+    (reference_attention_mask) against TextDataset items collated by
+    collate_batch, and checks that both give the same batches."""
+    batches = [range(start, min(start+batch_size, len(dataset)))
+               for start in range(0, min(len(dataset), n_batches*batch_size), batch_size)]
+
+    def reference_item(x):
+        attn_mask = reference_attention_mask(x.input_ids, x.position_idx, x.dfg_to_code, x.dfg_to_dfg)
+        return (torch.tensor(x.input_ids), torch.tensor(attn_mask), torch.tensor(x.position_idx),
+                torch.tensor(x.label), torch.tensor(x.soft_label))
+
+    start = time.time()
+    reference = [default_collate([reference_item(dataset.examples[i]) for i in batch]) for batch in batches]
+    reference_time = (time.time()-start)/len(batches)
+    start = time.time()
+    batched = [collate_batch([dataset[i] for i in batch]) for batch in batches]
+    batched_time = (time.time()-start)/len(batches)
+    for a, b in zip(reference, batched):
+        assert all(torch.equal(x, y) for x, y in zip(a, b[:len(a)]))
+    logger.info("Attention masks per batch of %d: %.2f ms with the per-item loops, %.2f ms batched",
+                batch_size, reference_time*1e3, batched_time*1e3)
+
 def set_seed(seed=42):
     random.seed(seed)
     os.environ['PYHTONHASHSEED'] = str(seed)
@@ -186,14 +310,15 @@ def set_seed(seed=42):
     torch.backends.cudnn.deterministic = True
 
 
-def train(args, train_dataset, model, tokenizer):
+def train(args, train_dataset, model, tokenizer, eval_dataloader):
     """ Train the model """
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
     train_sampler = RandomSampler(
         train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
 
     train_dataloader = DataLoader(train_dataset, sampler=train_sampler,
-                                  batch_size=args.train_batch_size, num_workers=0, pin_memory=True)
+                                  batch_size=args.train_batch_size, num_workers=args.num_workers, pin_memory=True,
+                                  collate_fn=collate_batch)
     args.max_steps = args.epoch*len(train_dataloader)
     args.save_steps = len(train_dataloader)
     args.warmup_steps = len(train_dataloader)
@@ -267,8 +392,9 @@ def train(args, train_dataset, model, tokenizer):
             position_idx = batch[2].to(args.device)
             labels = batch[3].to(args.device)
             soft_knowledge = batch[4].to(args.device)
+            spans = batch[5].to(args.device)
             model.train()
-            _, logits = model(inputs_ids, attn_mask, position_idx, labels)
+            _, logits = model(inputs_ids, attn_mask, position_idx, spans, labels)
 
             loss = distill_loss(logits, soft_knowledge)
             if args.n_gpu > 1:
@@ -309,7 +435,7 @@ def train(args, train_dataset, model, tokenizer):
                     # Only evaluate when single GPU otherwise metrics may not average well
                     if args.local_rank == -1 and args.evaluate_during_training:
                         results = evaluate(
-                            args, model, tokenizer, eval_when_training=True)
+                            args, model, tokenizer, eval_dataloader, eval_when_training=True)
                         for key, value in results.items():
                             logger.info("  %s = %s", key, round(value, 4))
                         # Save model checkpoint
@@ -333,21 +459,28 @@ def train(args, train_dataset, model, tokenizer):
                             "Saving model checkpoint to %s", output_dir)
 
 
-def evaluate(args, model, tokenizer, eval_when_training=False):
-    # Loop to handle MNLI double evaluation (matched, mis-matched)
-    eval_output_dir = args.output_dir
-
-    eval_dataset = TextDataset(tokenizer, args, args.eval_data_file)
-
-    if not os.path.exists(eval_output_dir) and args.local_rank in [-1, 0]:
-        os.makedirs(eval_output_dir)
+def build_eval_dataloader(args, tokenizer, file_path):
+    """Builds the dataset and dataloader of an eval or test file once, so that
+    evaluations during training only run inference."""
+    start = time.time()
+    eval_dataset = TextDataset(tokenizer, args, file_path)
+    logger.info("Built %d examples from %s in %.1fs", len(eval_dataset), file_path, time.time()-start)
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
     eval_sampler = SequentialSampler(
         eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler,
-                                 batch_size=args.eval_batch_size, num_workers=0, pin_memory=True)
+    return DataLoader(eval_dataset, sampler=eval_sampler,
+                      batch_size=args.eval_batch_size, num_workers=args.num_workers, pin_memory=True,
+                      collate_fn=collate_batch)
+
+
+def evaluate(args, model, tokenizer, eval_dataloader, eval_when_training=False):
+    # Loop to handle MNLI double evaluation (matched, mis-matched)
+    eval_output_dir = args.output_dir
+
+    if not os.path.exists(eval_output_dir) and args.local_rank in [-1, 0]:
+        os.makedirs(eval_output_dir)
 
     # multi-gpu evaluate
     if args.n_gpu > 1 and eval_when_training is False:
@@ -355,7 +488,7 @@ def evaluate(args, model, tokenizer, eval_when_training=False):
 
     # Eval!
     logger.info("***** Running evaluation *****")
-    logger.info("  Num examples = %d", len(eval_dataset))
+    logger.info("  Num examples = %d", len(eval_dataloader.dataset))
     logger.info("  Batch size = %d", args.eval_batch_size)
     eval_loss = 0.0
     nb_eval_steps = 0
@@ -367,9 +500,10 @@ def evaluate(args, model, tokenizer, eval_when_training=False):
         attn_mask = batch[1].to(args.device)
         position_idx = batch[2].to(args.device)
         label = batch[3].to(args.device)
+        spans = batch[5].to(args.device)
 
         with torch.no_grad():
-            lm_loss, logit = model(inputs_ids, attn_mask, position_idx, label)
+            lm_loss, logit = model(inputs_ids, attn_mask, position_idx, spans, label)
             eval_loss += lm_loss.mean().item()
             logit = F.softmax(logit)
             logits.append(logit.cpu().numpy())
@@ -399,16 +533,9 @@ def evaluate(args, model, tokenizer, eval_when_training=False):
     return result
 
 
-def test(args, model, tokenizer):
+def test(args, model, tokenizer, eval_dataloader):
     # Loop to handle MNLI double evaluation (matched, mis-matched)
-    eval_dataset = TextDataset(tokenizer, args, args.test_data_file)
-
-    args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(
-        eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(
-        eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    eval_dataset = eval_dataloader.dataset
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -428,8 +555,9 @@ def test(args, model, tokenizer):
         attn_mask = batch[1].to(args.device)
         position_idx = batch[2].to(args.device)
         label = batch[3].to(args.device)
+        spans = batch[5].to(args.device)
         with torch.no_grad():
-            lm_loss, logit = model(inputs_ids, attn_mask, position_idx, label)
+            lm_loss, logit = model(inputs_ids, attn_mask, position_idx, spans, label)
             logit = F.softmax(logit)
             logits.append(logit.cpu().numpy())
             labels.append(label.cpu().numpy())
@@ -493,6 +621,8 @@ def main():
                         help="Whether to run eval on the dev set.")
     parser.add_argument("--evaluate_during_training", action='store_true',
                         help="Run evaluation during training at each logging step.")
+    parser.add_argument("--benchmark_collate", action='store_true',
+                        help="Time batched attention-mask collation against per-item masks on the dev set.")
     parser.add_argument("--do_lower_case", action='store_true',
                         help="Set this flag if you are using an uncased model.")
 
@@ -500,6 +630,8 @@ def main():
                         help="Batch size per GPU/CPU for training.")
     parser.add_argument("--eval_batch_size", default=4, type=int,
                         help="Batch size per GPU/CPU for evaluation.")
+    parser.add_argument("--num_workers", default=4, type=int,
+                        help="Number of DataLoader worker processes.")
     parser.add_argument("--choice", default="best", type=str,
                         help="Model to test")
     parser.add_argument("--type", default="label_train", type=str,
@@ -668,6 +800,13 @@ def main():
         torch.distributed.barrier()
 
     logger.info("Training/evaluation parameters %s", args)
+    # only built when something evaluates on it, and never on other ranks
+    eval_dataloader = None
+    if args.local_rank in [-1, 0] and args.eval_data_file and \
+            (args.evaluate_during_training or args.do_eval or args.benchmark_collate):
+        eval_dataloader = build_eval_dataloader(args, tokenizer, args.eval_data_file)
+    if args.benchmark_collate and args.local_rank in [-1, 0]:
+        benchmark_collate(eval_dataloader.dataset, args.eval_batch_size)
 
     # Training
     if args.do_train:
@@ -679,7 +818,7 @@ def main():
         if args.local_rank == 0:
             torch.distributed.barrier()
 
-        train(args, train_dataset, model, tokenizer)
+        train(args, train_dataset, model, tokenizer, eval_dataloader)
 
     results = {}
     if args.do_eval and args.local_rank in [-1, 0]:
@@ -688,7 +827,7 @@ def main():
             args.output_dir, '{}'.format(checkpoint_prefix))
         model.load_state_dict(torch.load(output_dir))
         model.to(args.device)
-        result = evaluate(args, model, tokenizer)
+        result = evaluate(args, model, tokenizer, eval_dataloader)
         logger.info("***** Eval results *****")
         for key in sorted(result.keys()):
             logger.info("  %s = %s", key, str(round(result[key], 4)))
@@ -699,7 +838,8 @@ def main():
             checkpoint_prefix), args.size, args.choice, "model.bin")
         model.load_state_dict(torch.load(output_dir))
         model.to(args.device)
-        test(args, model, tokenizer)
+        test_dataloader = build_eval_dataloader(args, tokenizer, args.test_data_file)
+        test(args, model, tokenizer, test_dataloader)
 
         # --- CSV Saving Logic ---
         csv_file_exists = os.path.exists(args.result_csv_path)
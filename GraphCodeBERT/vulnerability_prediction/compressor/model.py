@@ -3,6 +3,35 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def average_node_embeddings(inputs_embeddings, position_idx, spans):
+    """Replaces the embedding of each data-flow node with the mean embedding of
+    the code tokens it is identified from. spans is the [B, N, 2] code span of
+    each node, padded with empty (0, 0) spans. The mean is a scatter-add over
+    the span tokens, so its cost grows with their count rather than with L*L."""
+    bs, l, d = inputs_embeddings.size()
+    node_index = position_idx.gt(1).sum(1, keepdim=True)
+    n_nodes = position_idx.eq(0).sum(1, keepdim=True)
+    # only the real nodes, not the padding spans, and only spans within the
+    # code, as in the graph-guided attention mask
+    node_ids = torch.arange(spans.size(1), device=spans.device)
+    batch, node = torch.nonzero(
+        (node_ids < n_nodes) & (spans[..., 0] < node_index) & (spans[..., 1] < node_index), as_tuple=True)
+    start, end = spans[batch, node, 0], spans[batch, node, 1]
+    widths = (end-start).clamp(min=0)
+    # flat rows of the nodes and of the tokens of their spans
+    node_rows = batch*l+node_index[batch, 0]+node
+    token_rows = torch.arange(int(widths.sum()), device=spans.device) + \
+        torch.repeat_interleave(batch*l+start-torch.cumsum(widths, 0)+widths, widths)
+    flat_embeddings = inputs_embeddings.reshape(bs*l, d)
+    sums = flat_embeddings.new_zeros(bs*l, d).index_add_(
+        0, torch.repeat_interleave(node_rows, widths), flat_embeddings[token_rows])
+    counts = flat_embeddings.new_zeros(bs*l).index_add_(
+        0, node_rows, widths.to(flat_embeddings.dtype))
+    avg_embeddings = sums/(counts+1e-10)[:, None]
+    nodes_mask = position_idx.eq(0).view(bs*l, 1)
+    return torch.where(nodes_mask, avg_embeddings, flat_embeddings).view(bs, l, d)
+
+
 class Model(nn.Module):
     def __init__(self, encoder, config, tokenizer, args):
         super(Model, self).__init__()
@@ -12,20 +41,11 @@ class Model(nn.Module):
         self.args = args
         self.query = 0
 
-    def forward(self, inputs_ids=None, attn_mask=None, position_idx=None, labels=None):
-        nodes_mask = position_idx.eq(0)
-        token_mask = position_idx.ge(2)
-
+    def forward(self, inputs_ids, attn_mask, position_idx, spans, labels=None):
         inputs_embeddings = self.encoder.roberta.embeddings.word_embeddings(
             inputs_ids)
-        nodes_to_token_mask = nodes_mask[:, :,
-                                         None] & token_mask[:, None, :] & attn_mask
-        nodes_to_token_mask = nodes_to_token_mask / \
-            (nodes_to_token_mask.sum(-1)+1e-10)[:, :, None]
-        avg_embeddings = torch.einsum(
-            "abc,acd->abd", nodes_to_token_mask, inputs_embeddings)
-        inputs_embeddings = inputs_embeddings * \
-            (~nodes_mask)[:, :, None]+avg_embeddings*nodes_mask[:, :, None]
+        inputs_embeddings = average_node_embeddings(
+            inputs_embeddings, position_idx, spans)
         outputs = self.encoder(inputs_embeds=inputs_embeddings,
                                attention_mask=attn_mask, position_ids=position_idx)[0]
 
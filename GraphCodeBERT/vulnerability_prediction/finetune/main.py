@@ -16,6 +16,7 @@ sys.path.append('../../../parser')
 from tqdm import tqdm
 from model import Model
 from run_parser import extract_dataflow
+from dfg_cache import DFGCache
 from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data import DataLoader, Dataset, SequentialSampler, RandomSampler
 from transformers import (AdamW, get_linear_schedule_with_warmup,
@@ -58,10 +59,15 @@ class InputFeatures(object):
         self.label=label
 
         
-def convert_examples_to_features(js,tokenizer,args):
+def extract_code_dataflow(code):
+    """Code tokens and data flow of a C function, as stored in the DFG cache."""
+    dfg, _, code_tokens = extract_dataflow(code, "c")
+    return code_tokens, dfg
+
+def convert_examples_to_features(js,tokenizer,args,dfg_cache):
     #source
     code=' '.join(js['func'].split())
-    dfg, index_table, code_tokens = extract_dataflow(code, "c")
+    code_tokens, dfg = dfg_cache.load(code, "c", extract_code_dataflow)
 
     code_tokens=[tokenizer.tokenize('@ '+x)[1:] if idx!=0 else tokenizer.tokenize(x) for idx,x in enumerate(code_tokens)]
     ori2cur_pos={}
@@ -98,12 +104,14 @@ class TextDataset(Dataset):
     def __init__(self, tokenizer, args, file_path=None):
         self.examples = []
         self.args=args
+        dfg_cache=DFGCache(os.path.join(os.path.dirname(file_path), 'dfg_cache'))
+        logger.info("Reading data flow from cache %s", dfg_cache.cache_dir)
 
         with open(file_path) as f:
             for line in tqdm(f):
                 js=json.loads(line.strip())
 
-                self.examples.append(convert_examples_to_features(js,tokenizer,args))
+                self.examples.append(convert_examples_to_features(js,tokenizer,args,dfg_cache))
 
         if 'train' in file_path:
             for idx, example in enumerate(self.examples[:3]):
@@ -1,7 +1,9 @@
 """Computes the flops needed for training/running transformer networks."""
 """Partial code is from https://github.com/google-research/electra/blob/master/flops_computation.py"""
 
+import argparse
 import collections
+import numpy as np
 
 # random number, >=, multiply activations by dropout mask, multiply activations
 # by correction (1 / (1 - dropout_rate))
@@ -17,29 +19,39 @@ ACTIVATION_FLOPS = 8
 # max/substract (for stability), exp, sum, divide
 SOFTMAX_FLOPS = 5
 
+# storage size of one weight or activation element
+BYTES_PER_ELEMENT = collections.OrderedDict([
+    ("fp32", 4),
+    ("fp16", 2),
+    ("int8", 1)
+])
+
 
 class TransformerHparams(object):
     """Computes the train/inference FLOPs for transformers."""
 
-    def __init__(self, h=768, l=12, s=514, v=50265, i=3072, heads=12):
+    def __init__(self, h=768, l=12, s=514, v=50265, i=3072, heads=12, seq_len=None, batch_size=1, n_inputs=1):
         self.h = h  # hidden size
         self.l = l  # number of layers
-        self.s = s  # sequence length
+        self.s = s  # max positions, i.e. size of the position embedding table
         self.v = v  # vocab size
         self.e = h  # embedding size
         self.i = h * 4 if i is None else i  # intermediate size
         self.kqv = h
         self.heads = heads
+        self.seq_len = s if seq_len is None else seq_len  # tokens per input sequence
+        self.batch_size = batch_size  # requests per forward pass
+        self.n_inputs = n_inputs  # sequences per request, e.g. 2 for clone pairs
 
     def get_block_flops(self):
         block_flops = dict(
             kqv=3 * 2 * self.h * self.kqv,
             kqv_bias=3 * self.kqv,
-            attention_scores=2 * self.kqv * self.s,
-            attn_softmax=SOFTMAX_FLOPS * self.s * self.heads,
-            attention_dropout=DROPOUT_FLOPS * self.s * self.heads,
-            attention_scale=self.s * self.heads,
-            attention_weighted_avg_values=2 * self.h * self.s,
+            attention_scores=2 * self.kqv * self.seq_len,
+            attn_softmax=SOFTMAX_FLOPS * self.seq_len * self.heads,
+            attention_dropout=DROPOUT_FLOPS * self.seq_len * self.heads,
+            attention_scale=self.seq_len * self.heads,
+            attention_weighted_avg_values=2 * self.h * self.seq_len,
             attn_output=2 * self.h * self.h,
             attn_output_bias=self.h,
             attn_output_dropout=DROPOUT_FLOPS * self.h,
@@ -54,7 +66,7 @@ class TransformerHparams(object):
             output_residual=self.h,
             output_layer_norm=LAYER_NORM_FLOPS * self.h
         )
-        return sum(block_flops.values()) * self.s
+        return sum(block_flops.values()) * self.seq_len
 
     def get_embedding_flops(self):
         """Get the forward-pass FLOPs the transformer inputs or output softmax."""
@@ -68,7 +80,7 @@ class TransformerHparams(object):
             emb_dropout=DROPOUT_FLOPS * self.e
         ))
 
-        return sum(embedding_flops.values()) * self.s
+        return sum(embedding_flops.values()) * self.seq_len
 
     def get_binary_classification_flops(self):
         classification_flops = dict(
@@ -78,7 +90,7 @@ class TransformerHparams(object):
             logits=2 * self.h
             # soft_logits=2 * SOFTMAX_FLOPS
         )
-        return sum(classification_flops.values()) * self.s
+        return sum(classification_flops.values()) * self.seq_len
 
     def get_infer_flops(self):
         """Get the FLOPs for running inference with the transformer on a
@@ -88,6 +100,30 @@ class TransformerHparams(object):
                 self.get_embedding_flops() +
                 self.get_binary_classification_flops())
 
+    def get_request_flops(self):
+        """Inference FLOPs of one forward pass over batch_size requests of
+        n_inputs sequences each."""
+        return self.get_infer_flops() * self.batch_size * self.n_inputs
+
+    def get_attention_traffic(self, bytes_per_element=4):
+        """Bytes of attention memory traffic per forward pass. Per layer the
+        heads x seq_len x seq_len score matrix is written by QK^T, read and
+        written by the scaling and by the softmax, and read by the weighted
+        average; Q and K are read once, V is read and the context written."""
+        score_accesses = 6 * self.heads * self.seq_len * self.seq_len
+        qkv_accesses = 4 * self.seq_len * self.kqv
+        return (self.l * (score_accesses + qkv_accesses) * self.batch_size * self.n_inputs *
+                bytes_per_element)
+
+    def get_activation_memory(self, bytes_per_element=4):
+        """Peak live activation bytes per forward pass: the residual stream plus
+        the larger of the attention stage (Q, K, V, scores and probabilities)
+        and the feed-forward stage (intermediate and output)."""
+        attention = 3 * self.seq_len * self.kqv + 2 * self.heads * self.seq_len * self.seq_len
+        feed_forward = self.seq_len * self.i + self.seq_len * self.h
+        peak = self.seq_len * self.h + np.maximum(attention, feed_forward)
+        return peak * self.batch_size * self.n_inputs * bytes_per_element
+
     def get_params(self):
         embedding_params = {}
         embedding_params.update(dict(
@@ -114,6 +150,65 @@ class TransformerHparams(object):
         # print(sum(embedding_params.values()), sum(block_params.values()) * self.l, sum(classification_params.values()))
         return sum(embedding_params.values()) + sum(block_params.values()) * self.l + sum(classification_params.values())
 
+    def get_layer_activation_size(self, dtype="fp32"):
+        """Bytes of activations one layer produces per forward pass: Q, K, V,
+        attention context, attention output, intermediate and layer output."""
+        elements = self.seq_len * (3 * self.kqv + 3 * self.h + self.i)
+        return elements * self.batch_size * self.n_inputs * BYTES_PER_ELEMENT[dtype]
+
+    def get_kv_size(self, dtype="fp32"):
+        """Bytes of the keys and values of one layer per forward pass."""
+        return 2 * self.seq_len * self.kqv * self.batch_size * self.n_inputs * BYTES_PER_ELEMENT[dtype]
+
+    def get_attention_matrix_size(self, dtype="fp32"):
+        """Bytes of the heads x seq_len x seq_len score matrix of one layer."""
+        return (self.heads * self.seq_len * self.seq_len * self.batch_size * self.n_inputs *
+                BYTES_PER_ELEMENT[dtype])
+
+    def get_weight_bytes(self, dtype="fp32"):
+        """Bytes of weights read per forward pass: every layer and head weight,
+        but only the token and position embedding rows that are looked up."""
+        tokens = self.seq_len * self.batch_size * self.n_inputs
+        read_params = (self.get_params() - self.v * self.h - self.s * self.h +
+                       np.minimum(self.v, tokens) * self.h + np.minimum(self.s, self.seq_len) * self.h)
+        return read_params * BYTES_PER_ELEMENT[dtype]
+
+    def get_bytes_moved(self, dtype="fp32"):
+        """Bytes moved per forward pass: weights read once, each layer's
+        activations written and read back once, plus the attention traffic."""
+        return (self.get_weight_bytes(dtype) + 2 * self.l * self.get_layer_activation_size(dtype) +
+                self.get_attention_traffic(BYTES_PER_ELEMENT[dtype]))
+
+    def get_arithmetic_intensity(self, dtype="fp32"):
+        """FLOPs per byte moved of one forward pass."""
+        return self.get_request_flops() / self.get_bytes_moved(dtype)
+
+    def get_roofline(self, peak_gflops, bandwidth_gbs, dtype="fp32"):
+        """Roofline estimate for a machine with the given peak compute (GFLOP/s)
+        and memory bandwidth (GB/s). The pass is memory-bound when its
+        arithmetic intensity is below the ridge point peak/bandwidth."""
+        intensity = self.get_arithmetic_intensity(dtype)
+        attainable_gflops = np.minimum(peak_gflops, intensity * bandwidth_gbs)
+        return dict(
+            arithmetic_intensity=intensity,
+            ridge_point=peak_gflops / bandwidth_gbs,
+            memory_bound=intensity < peak_gflops / bandwidth_gbs,
+            attainable_gflops=attainable_gflops,
+            latency_ms=self.get_request_flops() / (attainable_gflops * 1e9) * 1e3
+        )
+
+    def get_memory_report(self, dtype="fp32"):
+        """Per-forward-pass memory footprint and traffic in bytes for a dtype."""
+        return collections.OrderedDict([
+            ("weight_bytes", self.get_params() * BYTES_PER_ELEMENT[dtype]),
+            ("weight_bytes_read", self.get_weight_bytes(dtype)),
+            ("layer_activation_bytes", self.get_layer_activation_size(dtype)),
+            ("kv_bytes_per_layer", self.get_kv_size(dtype)),
+            ("attention_matrix_bytes_per_layer", self.get_attention_matrix_size(dtype)),
+            ("peak_activation_bytes", self.get_activation_memory(BYTES_PER_ELEMENT[dtype])),
+            ("bytes_moved", self.get_bytes_moved(dtype))
+        ])
+
 
 MODEL_FLOPS = collections.OrderedDict([
     ("roberta", [TransformerHparams().get_infer_flops(),
@@ -122,9 +217,36 @@ MODEL_FLOPS = collections.OrderedDict([
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden_dim", default=768, type=int)
+    parser.add_argument("--n_layers", default=12, type=int)
+    parser.add_argument("--vocab_size", default=50265, type=int)
+    parser.add_argument("--intermediate_size", default=3072, type=int)
+    parser.add_argument("--attention_heads", default=12, type=int)
+    parser.add_argument("--seq_len", default=514, type=int)
+    parser.add_argument("--batch_size", default=1, type=int)
+    parser.add_argument("--n_inputs", default=1, type=int)
+    parser.add_argument("--peak_gflops", default=100.0, type=float,
+                        help="Peak compute of the target machine in GFLOP/s.")
+    parser.add_argument("--bandwidth", default=20.0, type=float,
+                        help="Memory bandwidth of the target machine in GB/s.")
+    args = parser.parse_args()
+
     for k, v in MODEL_FLOPS.items():
         print(k, v)
 
+    model = TransformerHparams(args.hidden_dim, args.n_layers, 514, args.vocab_size, args.intermediate_size,
+                               args.attention_heads, seq_len=args.seq_len, batch_size=args.batch_size,
+                               n_inputs=args.n_inputs)
+    print("flops", model.get_request_flops())
+    print("params", model.get_params())
+    for dtype in BYTES_PER_ELEMENT:
+        print(dtype)
+        for k, v in model.get_memory_report(dtype).items():
+            print("  %s %s" % (k, v))
+        for k, v in model.get_roofline(args.peak_gflops, args.bandwidth, dtype).items():
+            print("  %s %s" % (k, v))
+
 
 if __name__ == "__main__":
     main()
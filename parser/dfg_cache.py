@@ -0,0 +1,53 @@
+import os
+import pickle
+import hashlib
+
+# bump when the extraction, the normalization or the pinned tree-sitter
+# grammars change, so stale entries are not read back
+DFG_CACHE_VERSION = 3
+
+
+def normalize(code):
+    """Cache key form of a source: each line stripped and its whitespace runs
+    collapsed, and blank lines dropped. Line breaks are kept since they end
+    line comments, so a whitespace-joined source is already normalized."""
+    lines = (" ".join(line.split()) for line in code.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+class DFGCache(object):
+    """Content-addressed on-disk store of the code tokens and data flow graph
+    extracted from each function, shared by the fine-tuning and distillation
+    pipelines of a dataset. Entries are keyed by a SHA1 of the language and the
+    normalized source, so reindented copies of a function share an entry, while
+    extraction still parses the source as given. Entries do not depend on the
+    tokenizer: a run with another vocab_size only redoes the subword
+    tokenization."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, code, lang):
+        sha = hashlib.sha1(repr((DFG_CACHE_VERSION, lang)).encode("UTF-8"))
+        sha.update(normalize(code).encode("UTF-8", "surrogatepass"))
+        key = sha.hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ".pkl")
+
+    def load(self, code, lang, extract):
+        """Returns the (code_tokens, dfg) of code, running extract(code) and
+        storing its result when the entry is missing."""
+        path = self.path(code, lang)
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+        code_tokens, dfg = extract(code)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write a private file first so readers never see a partial entry
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump((code_tokens, dfg), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return code_tokens, dfg
@@ -1,11 +1,16 @@
+import os
+import csv
+import json
 import copy
-import random
+import collections
+import time
 import logging
-import hashlib
 import warnings
 import argparse
+import numpy as np
 
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 from flops import TransformerHparams
 
 warnings.filterwarnings("ignore")
@@ -18,141 +23,714 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+GENE_KEYS = ["vocab_size", "attention_heads", "hidden_dim", "intermediate_size", "n_layers"]
+
+
+def transformer_hparams(args, genes):
+    """TransformerHparams for broadcastable arrays of gene values, costed for the
+    sequence length, batch size and inputs per request given in args."""
+    return TransformerHparams(genes["hidden_dim"], genes["n_layers"], 514, genes["vocab_size"],
+                              genes["intermediate_size"], genes["attention_heads"],
+                              seq_len=args.seq_len, batch_size=args.batch_size, n_inputs=args.n_inputs)
+
+
+def score_genes(args, genes):
+    """Returns (fitness, params, flops) for broadcastable arrays of gene values.
+    The fitness weighs per-sequence FLOPs against the size penalty, so batch_size
+    and n_inputs do not change the winner; the returned flops are per request."""
+    model = transformer_hparams(args, genes)
+    params = model.get_params()
+
+    size_diff = np.abs(args.target_size - params)*4/1e6
+    return model.get_infer_flops()/1e9 - size_diff, params, model.get_request_flops()
+
+
+def flops_fitness(args, genes):
+    """Default cost model: analytic FLOPs minus the size penalty."""
+    return score_genes(args, genes)[0]
+
+
+class LatencyCostModel(object):
+    """Cost model that instantiates the candidate student RobertaModel on CPU and
+    times a forward pass over a fixed-length batch. Measurements are kept in a
+    JSON file keyed by gene, sequence length, batch size and thread count, so
+    repeated searches only time genes they have never seen."""
+
+    def __init__(self, cache_path, seq_len=400, batch_size=1, threads=1, repeats=5):
+        self.cache_path = cache_path
+        self.seq_len = seq_len
+        self.batch_size = batch_size
+        self.threads = threads
+        self.repeats = repeats
+        self.measured = None
+
+    def key(self, gene_param):
+        return "%s|seq_len=%d|batch_size=%d|threads=%d" % (
+            "-".join(str(gene_param[key]) for key in GENE_KEYS), self.seq_len, self.batch_size, self.threads)
+
+    def load(self):
+        self.measured = {}
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                self.measured = json.load(f)
+
+    def save(self):
+        # merge with entries written meanwhile by other searches, then swap atomically
+        measured = self.measured
+        self.load()
+        self.measured.update(measured)
+        tmp_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self.measured, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def measure(self, gene_param):
+        import torch
+        from transformers import RobertaConfig, RobertaModel
+
+        torch.set_num_threads(self.threads)
+        config = RobertaConfig(vocab_size=gene_param["vocab_size"],
+                               hidden_size=gene_param["hidden_dim"],
+                               num_hidden_layers=gene_param["n_layers"],
+                               num_attention_heads=gene_param["attention_heads"],
+                               intermediate_size=gene_param["intermediate_size"],
+                               max_position_embeddings=514, type_vocab_size=1,
+                               layer_norm_eps=1e-5, pad_token_id=1)
+        model = RobertaModel(config).eval()
+        input_ids = torch.randint(3, gene_param["vocab_size"], (self.batch_size, self.seq_len))
+
+        timings = []
+        with torch.no_grad():
+            model(input_ids=input_ids)
+            for _ in range(self.repeats):
+                start = time.perf_counter()
+                model(input_ids=input_ids)
+                timings.append(time.perf_counter() - start)
+        return float(np.median(timings)) * 1e3
+
+    def latency(self, genes):
+        """Measured latency in ms for arrays of gene values."""
+        if self.measured is None:
+            self.load()
+        latency = np.empty(len(genes["vocab_size"]))
+        new = False
+        for row in range(len(latency)):
+            gene_param = {key: int(genes[key][row]) for key in GENE_KEYS}
+            key = self.key(gene_param)
+            if key not in self.measured:
+                self.measured[key] = self.measure(gene_param)
+                new = True
+            latency[row] = self.measured[key]
+        if new:
+            self.save()
+        return latency
+
+    def __call__(self, args, genes):
+        _, params, _ = score_genes(args, genes)
+        size_diff = np.abs(args.target_size - params)*4/1e6
+        return -args.latency_weight*self.latency(genes) - size_diff
+
+    def flops_correlation(self):
+        """Pearson and Spearman correlation between analytic FLOPs and measured
+        latency over every gene measured with this setup."""
+        if self.measured is None:
+            self.load()
+        setup = self.key({key: 0 for key in GENE_KEYS}).split("|", 1)[1]
+        genes, latency = [], []
+        for key, value in self.measured.items():
+            gene, gene_setup = key.split("|", 1)
+            if gene_setup == setup:
+                genes.append([int(x) for x in gene.split("-")])
+                latency.append(value)
+        if len(genes) < 2:
+            return None
+        genes = np.array(genes, dtype=np.int64)
+        latency = np.array(latency)
+        values = dict(zip(GENE_KEYS, genes.T))
+        flops = TransformerHparams(values["hidden_dim"], values["n_layers"], 514, values["vocab_size"],
+                                   values["intermediate_size"], values["attention_heads"], seq_len=self.seq_len,
+                                   batch_size=self.batch_size).get_request_flops()
+        pearson = np.corrcoef(flops, latency)[0, 1]
+        spearman = np.corrcoef(np.argsort(np.argsort(flops)), np.argsort(np.argsort(latency)))[0, 1]
+        return len(genes), pearson, spearman
+
+
+def make_cost_model(args):
+    if args.objective == "latency":
+        return LatencyCostModel(args.latency_cache, args.latency_seq_len, args.latency_batch_size,
+                                args.latency_threads)
+    return flops_fitness
+
+
+def report_flops_correlation(args):
+    correlation = make_cost_model(args).flops_correlation()
+    if correlation is not None:
+        logger.info("FLOPs vs measured latency over %d genes: Pearson %.4f, Spearman %.4f" % correlation)
+
+
+class FitnessCache(object):
+    """Bounded LRU map from Genome.hash to fitness, so survivors and re-discovered
+    genes are never scored twice by the cost model."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.store = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.store:
+            self.store.move_to_end(key)
+            self.hits += 1
+            return self.store[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.store[key] = value
+        self.store.move_to_end(key)
+        if len(self.store) > self.maxsize:
+            self.store.popitem(last=False)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __str__(self):
+        total = self.hits + self.misses
+        return "%d hits, %d misses (%.1f%% hit rate), %d cached" % (
+            self.hits, self.misses, 100.0*self.hits/max(total, 1), len(self.store))
+
+
+def pareto_front(size_diff, flops):
+    """Indices of the points not dominated in (lower size error, higher FLOPs)."""
+    order = np.lexsort((-flops, size_diff))
+    sorted_flops = flops[order]
+    running_max = np.maximum.accumulate(sorted_flops)
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = sorted_flops[1:] > running_max[:-1]
+    return order[keep]
+
+
+def exact_search(args, search_space, top_k=10):
+    """Scores every point of the search space, one (n_layers, attention_heads)
+    slice at a time so each pass is a dense vocab x hidden x intermediate grid.
+    Returns the top_k genes by fitness and the size/FLOPs Pareto front sorted by
+    distance to the target size."""
+    vocab = np.array(search_space["vocab_size"], dtype=np.int64)[:, None, None]
+    hidden = np.array(search_space["hidden_dim"], dtype=np.int64)[None, :, None]
+    intermediate = np.array(search_space["intermediate_size"], dtype=np.int64)[None, None, :]
+    grid_shape = (vocab.shape[0], hidden.shape[1], intermediate.shape[2])
+
+    candidates = []
+    front = []
+    for n_layers in search_space["n_layers"]:
+        for heads in search_space["attention_heads"]:
+            genes = {"vocab_size": vocab, "attention_heads": heads, "hidden_dim": hidden,
+                     "intermediate_size": intermediate, "n_layers": n_layers}
+            scores, params, flops = score_genes(args, genes)
+            scores = scores.ravel()
+            params = np.broadcast_to(params, grid_shape).ravel()
+            flops = np.broadcast_to(flops, grid_shape).ravel()
+            size_diff = np.abs(args.target_size - params)*4/1e6
+
+            def point(idx):
+                v, h, i = np.unravel_index(idx, grid_shape)
+                gene_param = {"vocab_size": int(vocab[v, 0, 0]), "attention_heads": heads,
+                              "hidden_dim": int(hidden[0, h, 0]),
+                              "intermediate_size": int(intermediate[0, 0, i]), "n_layers": n_layers}
+                return float(scores[idx]), float(size_diff[idx]), int(flops[idx]), gene_param
+
+            k = min(top_k, scores.size)
+            candidates.extend(point(idx) for idx in np.argpartition(-scores, k - 1)[:k])
+            front.extend(point(idx) for idx in pareto_front(size_diff, flops))
+
+    candidates = sorted(candidates, key=lambda x: x[0], reverse=True)[:top_k]
+    front_size_diff = np.array([p[1] for p in front])
+    front_flops = np.array([p[2] for p in front])
+    front = [front[i] for i in pareto_front(front_size_diff, front_flops)]
+    return candidates, front[:top_k]
+
 
 class Genome(object):
-    def __init__(self, gene_param=None):
-        self.fitness = 0.0
-        self.gene_param = gene_param
+    """Decoded view of one row of the GA population matrix."""
 
-        if not self.gene_param:
-            self.hash = 0
-        else:
-            self.update_hash()
-    
-    def update_hash(self):
-        gene_string = str(self.gene_param["intermediate_size"])+ \
-                        str(self.gene_param["vocab_size"]) + \
-                        str(self.gene_param["attention_heads"]) + \
-                        str(self.gene_param["hidden_dim"]) + \
-                        str(self.gene_param["n_layers"]) 
-        self.hash = hashlib.md5(gene_string.encode("UTF-8")).hexdigest()
-
-    def mutation(self, search_space):
-        genome_len = len(self.gene_param)
-        loc = random.randint(0, genome_len - 1)
-
-        for x in range(genome_len):
-            if x >= loc:
-                mutated_gene = list(self.gene_param.keys())[x]
-                current_value = self.gene_param[mutated_gene]
-                possible_choices = copy.deepcopy(search_space[mutated_gene])
-                possible_choices.remove(current_value)
-                self.gene_param[mutated_gene] = random.choice(possible_choices)
-        self.update_hash()
+    def __init__(self, gene_param=None, fitness=0.0, hash=0):
+        self.fitness = fitness
+        self.gene_param = gene_param
+        self.hash = hash
 
 
 class GA_search():
-    def __init__(self, args, search_space, cross_chance=0.6):
+    """GA over a population matrix: one int16 row per genome, one column per
+    gene in GENE_KEYS order, each entry an index into that gene's choices.
+    Crossover, mutation and duplicate removal work on whole matrices."""
+
+    def __init__(self, args, search_space, cross_chance=0.6, cost_model=flops_fitness, cache_size=100000):
         self.args = args
+        self.cost_model = cost_model
+        self.cache = FitnessCache(cache_size)
         self.search_space = search_space
         self.cross_chance = cross_chance
         self.desired_length = args.population_size
-        self.population = []
+        self.rng = np.random.default_rng(getattr(args, "seed", None))
+
+        self.choices = [np.array(search_space[key], dtype=np.int64) for key in GENE_KEYS]
+        self.space_sizes = np.array([len(c) for c in self.choices], dtype=np.int64)
+        # mixed-radix strides: the hash of a row is its rank in the full grid
+        self.strides = np.concatenate(([1], np.cumprod(self.space_sizes[:0:-1])))[::-1]
+        if np.prod(self.space_sizes) < args.population_size:
+            raise ValueError("population_size %d exceeds the %d genes of the search space" %
+                             (args.population_size, np.prod(self.space_sizes)))
+
+        self.population = np.empty((0, len(GENE_KEYS)), dtype=np.int16)
+        self.population_fitness = np.empty(0)
         self.best_gene = []
 
-    def is_duplicate(self, new_genome):
-        for genome in self.population:
-            if new_genome.hash == genome.hash:
-                return True
-        return False
+    def hashes(self, population):
+        return population.astype(np.int64) @ self.strides
+
+    def decode(self, population):
+        """Maps an index matrix back to arrays of gene values keyed by gene name."""
+        return {key: choices[population[:, j]] for j, (key, choices) in enumerate(zip(GENE_KEYS, self.choices))}
+
+    def genome(self, row, fitness=0.0):
+        genes = self.decode(row[None, :])
+        gene_param = {key: int(genes[key][0]) for key in GENE_KEYS}
+        return Genome(gene_param, fitness, int(self.hashes(row[None, :])[0]))
+
+    def mutation(self, population, rows):
+        """Mutates every gene from a random locus onwards, in place, for the given
+        rows; each mutated gene moves to a different choice of the same gene."""
+        n, genome_len = len(rows), population.shape[1]
+        loc = self.rng.integers(0, genome_len, size=n)
+        mutate = np.arange(genome_len)[None, :] >= loc[:, None]
+        shift = self.rng.integers(1, np.maximum(self.space_sizes, 2), size=(n, genome_len))
+        mutated = (population[rows].astype(np.int64) + shift) % self.space_sizes
+        population[rows] = np.where(mutate, mutated, population[rows])
+
+    def deduplicate(self, population, n_fixed=0):
+        """Mutates rows after the first n_fixed until every row is unique."""
+        while True:
+            _, first = np.unique(self.hashes(population), return_index=True)
+            duplicate = np.ones(len(population), dtype=bool)
+            duplicate[first] = False
+            duplicate[:n_fixed] = False
+            rows = np.flatnonzero(duplicate)
+            if len(rows) == 0:
+                return population
+            self.mutation(population, rows)
 
     def initialization(self):
-        count = 0
-
-        while count < self.args.population_size:
-            gene_param = {}
-            for key in self.search_space:
-                gene_param[key] = random.choice(self.search_space[key])
-            new_genome = Genome(gene_param)
-            
-            if len(self.population) > 0:
-                while self.is_duplicate(new_genome):
-                    new_genome.mutation(self.search_space)
-
-            self.population.append(copy.deepcopy(new_genome))
-            count += 1
-    
-    def fitness(self, genome):
-        vocab_size = genome.gene_param["vocab_size"]
-        attention_heads = genome.gene_param["attention_heads"]
-        hidden_dim = genome.gene_param["hidden_dim"]
-        intermediate_size = genome.gene_param["intermediate_size"]
-        n_layers = genome.gene_param["n_layers"]
-        model = TransformerHparams(hidden_dim, n_layers, 514, vocab_size, intermediate_size, attention_heads)
-        flops = model.get_infer_flops()
+        population = self.rng.integers(0, self.space_sizes, size=(self.args.population_size, len(GENE_KEYS)))
+        self.population = self.deduplicate(population.astype(np.int16))
+        self.population_fitness = self.fitness(self.population)
+
+    def cached_cost(self, population):
+        """Cost-model values for a population matrix. Cached genomes are filled
+        in from the LRU cache; the rest go through the cost model as gene-value
+        arrays in a single vectorized call."""
+        hashes = self.hashes(population).tolist()
+        values = [None] * len(population)
+        misses = []
+        for row, gene_hash in enumerate(hashes):
+            values[row] = self.cache.get(gene_hash)
+            if values[row] is None:
+                misses.append(row)
+
+        if len(misses) > 0:
+            computed = self.cost_model(self.args, self.decode(population[misses]))
+            for row, value in zip(misses, computed):
+                values[row] = value
+                self.cache.put(hashes[row], value)
+        return np.array(values, dtype=np.float64)
+
+    def fitness(self, population):
+        return self.cached_cost(population)
+
+    def crossover_and_mutation(self, parents_1, parents_2):
+        """Single-point crossover with probability cross_chance per pair,
+        otherwise both parents are mutated. Returns the children matrix."""
+        n, genome_len = parents_1.shape
+        children_1 = parents_1.copy()
+        children_2 = parents_2.copy()
+
+        cross = self.rng.random(n) < self.cross_chance
+        recomb_loc = self.rng.integers(1, genome_len, size=n)
+        swap = cross[:, None] & (np.arange(genome_len)[None, :] >= recomb_loc[:, None])
+        children_1[swap] = parents_2[swap]
+        children_2[swap] = parents_1[swap]
+
+        children = np.concatenate((children_1, children_2))
+        self.mutation(children, np.flatnonzero(np.concatenate((~cross, ~cross))))
+        return children
+
+    def generation(self):
+        n_pairs = (self.desired_length + 1) // 2
+        pop_size = len(self.population)
+        parent_1, parent_2 = self.select_parents(n_pairs)
+        children = self.crossover_and_mutation(self.population[parent_1], self.population[parent_2])
+
+        merged = self.deduplicate(np.concatenate((self.population, children)), n_fixed=pop_size)
+        merged_fitness = self.fitness(merged)
+
+        self.select(merged, merged_fitness)
+        best = self.best()
+        self.best_gene.append((best.gene_param, best.fitness))
+
+    def select_parents(self, n_pairs):
+        """Two distinct random parents per pair."""
+        pop_size = len(self.population)
+        parent_1 = self.rng.integers(0, pop_size, size=n_pairs)
+        parent_2 = self.rng.integers(0, pop_size - 1, size=n_pairs)
+        parent_2 += parent_2 >= parent_1
+        return parent_1, parent_2
+
+    def select(self, population, fitness):
+        graded = np.argsort(-fitness, kind="stable")[:self.args.population_size]
+        self.population = population[graded]
+        self.population_fitness = fitness[graded]
+
+    def migrate(self, immigrants):
+        """Merges immigrant rows from another island; the worst genomes make room."""
+        merged = np.concatenate((self.population, immigrants))
+        _, first = np.unique(self.hashes(merged), return_index=True)
+        merged = merged[np.sort(first)]
+        self.select(merged, self.fitness(merged))
+
+    def best(self):
+        return self.genome(self.population[0], float(self.population_fitness[0]))
+
+
+def non_dominated_sort(objectives):
+    """Pareto rank of each row of a minimization objective matrix, 0 being the
+    non-dominated front. Rows are visited in lexicographic order, where only
+    earlier rows can dominate, and each joins the first front with no member
+    dominating it, found by binary search; memory stays linear in the rows."""
+    rank = np.empty(len(objectives), dtype=np.int64)
+    # objectives of each front's members, in buffers grown by doubling
+    fronts, sizes = [], []
+    for row in np.lexsort(objectives.T[::-1]):
+        point = objectives[row]
+        low, high = 0, len(fronts)
+        while low < high:
+            mid = (low + high) // 2
+            members = fronts[mid][:sizes[mid]]
+            if ((members <= point).all(1) & (members < point).any(1)).any():
+                low = mid + 1
+            else:
+                high = mid
+        if low == len(fronts):
+            fronts.append(np.empty((16, objectives.shape[1]), dtype=objectives.dtype))
+            sizes.append(0)
+        elif sizes[low] == len(fronts[low]):
+            fronts[low] = np.concatenate((fronts[low], np.empty_like(fronts[low])))
+        fronts[low][sizes[low]] = point
+        sizes[low] += 1
+        rank[row] = low
+    return rank
+
+
+def constrained_sort(objectives, violation):
+    """Pareto rank under constraint domination: feasible rows (no violation) are
+    ranked by non_dominated_sort, infeasible rows after all of them by how much
+    they violate the constraint."""
+    rank = np.empty(len(objectives), dtype=np.int64)
+    feasible = violation <= 0
+    rank[feasible] = non_dominated_sort(objectives[feasible])
+    n_fronts = rank[feasible].max() + 1 if feasible.any() else 0
+    rank[~feasible] = n_fronts + np.unique(violation[~feasible], return_inverse=True)[1]
+    return rank
+
+
+def crowding_distance(objectives, rank):
+    """NSGA-II crowding distance, computed within each front on range-normalized
+    objectives; boundary points get infinity."""
+    span = objectives.max(0) - objectives.min(0)
+    normalized = (objectives - objectives.min(0)) / np.where(span > 0, span, 1)
+    distance = np.zeros(len(objectives))
+    for front in np.unique(rank):
+        members = np.flatnonzero(rank == front)
+        for m in range(objectives.shape[1]):
+            order = members[np.argsort(normalized[members, m], kind="stable")]
+            distance[order[[0, -1]]] = np.inf
+            distance[order[1:-1]] += normalized[order[2:], m] - normalized[order[:-2], m]
+    return distance
+
+
+def estimate_latency(args, model):
+    """Analytic CPU latency in ms from the fp32 roofline of the forward pass."""
+    return model.get_roofline(args.cpu_gflops, args.mem_bandwidth)["latency_ms"]
+
+
+class ParetoCostModel(object):
+    """Objectives minimized by NSGA_search: model bytes, negated inference FLOPs
+    and, when a LatencyCostModel is given, measured latency (ms). The roofline
+    estimate is compute-bound for nearly every gene, i.e. rescaled FLOPs that
+    no gene could trade against FLOPs, so it is only reported, not optimized."""
+
+    def __init__(self, latency_model=None):
+        self.latency_model = latency_model
+        self.n_objectives = 2 if latency_model is None else 3
+
+    def __call__(self, args, genes):
+        _, params, flops = score_genes(args, genes)
+        objectives = [params.astype(np.float64)*4, -flops.astype(np.float64)]
+        if self.latency_model is not None:
+            objectives.append(self.latency_model.latency(genes))
+        return np.stack(objectives, axis=1)
+
+
+class NSGA_search(GA_search):
+    """NSGA-II over the same population matrix: selection by Pareto rank and
+    crowding distance over ParetoCostModel objectives, plus a bounded archive of
+    the non-dominated genomes seen during the search. Genes larger than the
+    target size are infeasible and rank behind every feasible gene."""
+
+    def __init__(self, args, search_space, cross_chance=0.6, cost_model=None, cache_size=100000,
+                 archive_size=500):
+        super(NSGA_search, self).__init__(args, search_space, cross_chance,
+                                          cost_model or ParetoCostModel(), cache_size)
+        self.archive_size = archive_size
+        self.archive = np.empty((0, len(GENE_KEYS)), dtype=np.int16)
+        self.archive_objectives = np.empty((0, self.cost_model.n_objectives))
+
+    def rank(self, objectives):
+        """Constrained Pareto rank; the first objective is the model bytes."""
+        violation = np.maximum(objectives[:, 0] - self.args.target_size*4, 0)
+        return constrained_sort(objectives, violation)
+
+    def fitness(self, population):
+        """Scalar that sorts by rank, then by crowding distance within a rank."""
+        objectives = self.cached_cost(population)
+        self.update_archive(population, objectives)
+        rank = self.rank(objectives)
+        distance = crowding_distance(objectives, rank)
+        crowding = 0.5 - 0.5/(1 + distance)
+        return crowding - rank
+
+    def select_parents(self, n_pairs):
+        """Binary tournaments; the population is sorted best first, so the
+        smaller index wins."""
+        pop_size = len(self.population)
+        parents = self.rng.integers(0, pop_size, size=(2, n_pairs, 2)).min(-1)
+        return parents[0], parents[1]
+
+    def update_archive(self, population, objectives):
+        merged = np.concatenate((self.archive, population))
+        merged_objectives = np.concatenate((self.archive_objectives, objectives))
+        _, first = np.unique(self.hashes(merged), return_index=True)
+        first = np.sort(first)
+        merged, merged_objectives = merged[first], merged_objectives[first]
+        front = np.flatnonzero(self.rank(merged_objectives) == 0)
+        if len(front) > self.archive_size:
+            # keep the least crowded points so the archive spans the whole front
+            distance = crowding_distance(merged_objectives[front], np.zeros(len(front)))
+            front = front[np.argsort(-distance, kind="stable")[:self.archive_size]]
+        self.archive = merged[front]
+        self.archive_objectives = merged_objectives[front]
+
+    def front(self):
+        """The archive as dicts of genes, objectives and latency (measured or
+        estimated), sorted by latency."""
+        values = self.decode(self.archive)
+        model = transformer_hparams(self.args, values)
         params = model.get_params()
-        
-        size_diff = abs(self.args.target_size - params)*4/1e6
-        genome.fitness = flops/1e9 - size_diff
-
-    def crossover_and_mutation(self, parents):
-        children = []
-        parent_1, parent_2 = parents
-        if self.cross_chance > random.random():
-            genome_len = len(self.search_space)
-            recomb_loc = random.randint(1, genome_len - 1)
-
-            child_1 = {}
-            child_2 = {}
-
-            keys = list(self.search_space)
-            keys = sorted(keys)
-
-            for x in range(0, genome_len):
-                if x < recomb_loc:
-                    child_1[keys[x]] = parent_1.gene_param[keys[x]]
-                    child_2[keys[x]] = parent_2.gene_param[keys[x]]
-                else:
-                    child_1[keys[x]] = parent_2.gene_param[keys[x]]
-                    child_2[keys[x]] = parent_1.gene_param[keys[x]]
-            genome_1 = Genome(child_1)
-            genome_2 = Genome(child_2)
+        activation_memory = model.get_activation_memory()
+        if self.archive_objectives.shape[1] > 2:
+            latency = self.archive_objectives[:, 2]
         else:
-            genome_1 = copy.deepcopy(parent_1)
-            genome_2 = copy.deepcopy(parent_2)
+            latency = estimate_latency(self.args, model)
+        rows = []
+        for row in np.argsort(latency, kind="stable"):
+            point = {key: int(values[key][row]) for key in GENE_KEYS}
+            point.update(model_bytes=int(params[row])*4,
+                         size_diff_mb=float(abs(self.args.target_size - params[row])*4/1e6),
+                         flops=int(-self.archive_objectives[row, 1]),
+                         latency_ms=float(latency[row]),
+                         activation_bytes=int(activation_memory[row]))
+            rows.append(point)
+        return rows
+
+
+def write_front(front, path):
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(front[0]))
+            writer.writeheader()
+            writer.writerows(front)
+    else:
+        with open(path, "w") as f:
+            json.dump(front, f, indent=2)
+
+
+def pareto_search(args, search_space, front_output):
+    latency_model = make_cost_model(args) if args.objective == "latency" else None
+    searcher = NSGA_search(args, search_space, cost_model=ParetoCostModel(latency_model),
+                           cache_size=args.cache_size, archive_size=args.archive_size)
+    searcher.initialization()
+    for gen in tqdm(range(args.generation_size), desc="Searching"):
+        searcher.generation()
 
-            genome_1.mutation(self.search_space)
-            genome_2.mutation(self.search_space)
+    front = searcher.front()
+    write_front(front, front_output)
+    logger.info("fitness cache: %s" % searcher.cache)
+    logger.info("%d genes on the Pareto front written to %s" % (len(front), front_output))
+    return front
 
-        children.append(genome_1)
-        children.append(genome_2)
 
-        return children
+def ga_search(args, search_space):
+    searcher = GA_search(args, search_space, cost_model=make_cost_model(args), cache_size=args.cache_size)
+    searcher.initialization()
+    for gen in tqdm(range(args.generation_size), desc="Searching"):
+        # logger.info("***Start generate %d***" %(gen))
+        searcher.generation()
+
+    logger.info("fitness cache: %s" % searcher.cache)
+    return searcher.best()
+
+
+def evolve_island(searcher, n_generations):
+    for _ in range(n_generations):
+        searcher.generation()
+    return searcher
+
+
+def island_search(args, search_space, target_sizes):
+    """Runs args.islands independent GA populations per target size on a process
+    pool. Every args.migration_interval generations the best args.migrants genomes
+    of each island migrate to the next island of the same target (ring topology).
+    Returns one best Genome per target size."""
+    islands = {}
+    for target_size in target_sizes:
+        islands[target_size] = []
+        for i in range(args.islands):
+            island_args = target_args(args, target_size)
+            if args.seed is not None:
+                island_args.seed = args.seed + i
+            searcher = GA_search(island_args, search_space, cost_model=make_cost_model(args),
+                                 cache_size=args.cache_size)
+            searcher.initialization()
+            islands[target_size].append(searcher)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        bar = tqdm(total=args.generation_size, desc="Searching")
+        done = 0
+        while done < args.generation_size:
+            n_generations = min(args.migration_interval, args.generation_size - done)
+            futures = {target_size: [pool.submit(evolve_island, searcher, n_generations)
+                                     for searcher in islands[target_size]]
+                       for target_size in target_sizes}
+            for target_size in target_sizes:
+                islands[target_size] = [future.result() for future in futures[target_size]]
+                searchers = islands[target_size]
+                if len(searchers) > 1:
+                    emigrants = [searcher.population[:args.migrants].copy() for searcher in searchers]
+                    for i, searcher in enumerate(searchers):
+                        searcher.migrate(emigrants[i - 1])
+            done += n_generations
+            bar.update(n_generations)
+        bar.close()
+
+    results = {}
+    for target_size in target_sizes:
+        best = [searcher.best() for searcher in islands[target_size]]
+        results[target_size] = max(best, key=lambda genome: genome.fitness)
+        logger.info("%s MB island fitness: %s" %
+                    (target_size, ", ".join("%.4f" % genome.fitness for genome in best)))
+        for i, searcher in enumerate(islands[target_size]):
+            logger.info("%s MB island %d fitness cache: %s" % (target_size, i, searcher.cache))
+    return results
+
+
+def target_args(args, target_size):
+    """Copy of args with target_size (MB) converted to a parameter count."""
+    args = copy.copy(args)
+    args.target_size = target_size * 1e6/4
+    return args
+
+
+def run_exact(args, search_space):
+    n_points = np.prod([len(v) for v in search_space.values()])
+    logger.info("***Start exact search over %d genes, target model size %d MB***" %
+          (n_points, args.target_size*4/1e6))
+    start = time.time()
+    top_genes, front = exact_search(args, search_space, args.top_k)
+    exact_time = time.time() - start
+
+    logger.info("exact search finished in %.2fs" % exact_time)
+    logger.info("the best one:")
+    logger.info(top_genes[0][3])
+    logger.info("top %d genes (fitness, size diff MB, GFLOPs, gene):" % len(top_genes))
+    for fitness, size_diff, flops, gene_param in top_genes:
+        logger.info("%.4f %.4f %.4f %s" % (fitness, size_diff, flops/1e9, gene_param))
+    logger.info("Pareto front nearest to target (size diff MB, GFLOPs, gene):")
+    for _, size_diff, flops, gene_param in front:
+        logger.info("%.4f %.4f %s" % (size_diff, flops/1e9, gene_param))
+
+    if args.benchmark:
+        start = time.time()
+        best_genome = ga_search(args, search_space)
+        ga_time = time.time() - start
+        logger.info("GA: fitness %.4f in %.2fs, gene %s" %
+                    (best_genome.fitness, ga_time, best_genome.gene_param))
+        logger.info("exact: fitness %.4f in %.2fs, gap %.4f" %
+                    (top_genes[0][0], exact_time, top_genes[0][0] - best_genome.fitness))
 
-    def generation(self):
-        children = []
-        while len(children) < self.desired_length:
-            parents = random.sample(self.population, k=2)
-            children.extend(self.crossover_and_mutation(parents))
-
-        for genome in children:
-            while self.is_duplicate(genome):
-                genome.mutation(self.search_space)
-            self.population.append(copy.deepcopy(genome))
-        
-        for genome in self.population:
-            self.fitness(genome)
-
-        graded_genome = [x for x in sorted(self.population, key=lambda x: x.fitness, reverse=True)]
-        self.best_gene.append((graded_genome[0].gene_param, graded_genome[0].fitness))
-        self.population = graded_genome[:self.args.population_size]
 
 def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--population_size", default=50, type=int)
     parser.add_argument("--generation_size", default=100, type=int)
-    parser.add_argument("-t", "--target_size", default=3, type=float)
+    parser.add_argument("-t", "--target_size", default=[3], type=float, nargs="+",
+                        help="One or more target model sizes in MB.")
+    parser.add_argument("--seq_len", default=514, type=int,
+                        help="Tokens per input sequence, e.g. 400 for CodeBERT or 320 for GraphCodeBERT students.")
+    parser.add_argument("--batch_size", default=1, type=int,
+                        help="Requests per forward pass in the cost model.")
+    parser.add_argument("--n_inputs", default=1, type=int,
+                        help="Sequences per request, 2 for clone detection pairs.")
+    parser.add_argument("--seed", default=None, type=int,
+                        help="Random seed of the GA.")
+    parser.add_argument("--cache_size", default=100000, type=int,
+                        help="Maximum number of genes kept in the LRU fitness cache.")
+    parser.add_argument("--islands", default=1, type=int,
+                        help="Number of independent GA populations per target size.")
+    parser.add_argument("--migration_interval", default=10, type=int,
+                        help="Generations between migrations of the best genomes across islands.")
+    parser.add_argument("--migrants", default=2, type=int,
+                        help="Number of best genomes sent to the next island at each migration.")
+    parser.add_argument("--workers", default=os.cpu_count(), type=int,
+                        help="Number of processes running the islands.")
+    parser.add_argument("--objective", default="flops", choices=["flops", "latency"],
+                        help="Maximize analytic FLOPs, or minimize measured CPU latency, under the size target.")
+    parser.add_argument("--latency_cache", default="latency_cache.json", type=str,
+                        help="JSON file storing measured latencies across searches.")
+    parser.add_argument("--latency_seq_len", default=400, type=int,
+                        help="Sequence length of the timed forward pass.")
+    parser.add_argument("--latency_batch_size", default=1, type=int,
+                        help="Batch size of the timed forward pass.")
+    parser.add_argument("--latency_threads", default=1, type=int,
+                        help="Torch CPU threads used when timing.")
+    parser.add_argument("--latency_weight", default=1.0, type=float,
+                        help="Fitness penalty per ms of latency, against 1 per MB of size error.")
+    parser.add_argument("--pareto", action="store_true",
+                        help="Run NSGA-II over (model bytes, FLOPs, and with --objective latency the "
+                             "measured latency) for genes within the target size, and write the Pareto front.")
+    parser.add_argument("--front_output", default="pareto_front.json", type=str,
+                        help="Where --pareto writes the front, as JSON or, for a .csv path, CSV.")
+    parser.add_argument("--archive_size", default=500, type=int,
+                        help="Maximum number of Pareto genes kept, thinned by crowding distance.")
+    parser.add_argument("--cpu_gflops", default=100.0, type=float,
+                        help="Sustained CPU GFLOP/s assumed by the analytic latency estimate.")
+    parser.add_argument("--mem_bandwidth", default=20.0, type=float,
+                        help="Memory bandwidth in GB/s assumed by the analytic latency estimate.")
+    parser.add_argument("--exact", action="store_true",
+                        help="Score the whole search space (analytic FLOPs objective) instead of running the GA.")
+    parser.add_argument("--top_k", default=10, type=int,
+                        help="Number of best genes and Pareto points reported by --exact.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="With --exact, also run the GA and compare time and fitness.")
 
     args = parser.parse_args()
     search_space = {
@@ -163,22 +741,43 @@ def main():
         "n_layers": [*range(1, 13)]
     }
 
-    args.target_size = args.target_size * 1e6/4
+    if args.pareto:
+        for target_size in args.target_size:
+            front_output = args.front_output
+            if len(args.target_size) > 1:
+                root, ext = os.path.splitext(front_output)
+                front_output = "%s_%sMB%s" % (root, target_size, ext)
+            logger.info("***Start NSGA-II search for %d generations, %d population, target model size %s MB***" %
+                  (args.generation_size, args.population_size, target_size))
+            pareto_search(target_args(args, target_size), search_space, front_output)
+        return
+
+    if args.exact:
+        for target_size in args.target_size:
+            run_exact(target_args(args, target_size), search_space)
+        return
+
+    if args.islands > 1 or len(args.target_size) > 1:
+        logger.info("***Start GA search for %d generations, %d islands of %d population, target model sizes %s MB***" %
+              (args.generation_size, args.islands, args.population_size, args.target_size))
+        results = island_search(args, search_space, args.target_size)
+        for target_size, best_genome in results.items():
+            logger.info("the best one for %s MB:" % target_size)
+            logger.info(best_genome.gene_param)
+        if args.objective == "latency":
+            report_flops_correlation(args)
+        return
+
+    args = target_args(args, args.target_size[0])
     logger.info("***Start GA search for %d generations, %d population, target model size %d MB***" %
           (args.generation_size, args.population_size, args.target_size*4/1e6))
 
-    searcher = GA_search(args, search_space)
-    searcher.initialization()
-    for gen in tqdm(range(args.generation_size), desc="Searching"):
-        # logger.info("***Start generate %d***" %(gen))
-        searcher.generation()
-    
-    for genome in searcher.population:
-        searcher.fitness(genome)
-    graded_genome = [x for x in sorted(searcher.population, key=lambda x: x.fitness, reverse=True)]
+    best_genome = ga_search(args, search_space)
 
     logger.info("the best one:")
-    logger.info(graded_genome[0].gene_param)
+    logger.info(best_genome.gene_param)
+    if args.objective == "latency":
+        report_flops_correlation(args)
 
 
 if __name__ == "__main__":
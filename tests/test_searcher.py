@@ -0,0 +1,66 @@
+import os
+import sys
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import searcher  # noqa: E402
+
+SEARCH_SPACE = {
+    "vocab_size": [*range(1000, 51000, 1000)],
+    "attention_heads": [1, 2, 4, 8],
+    "hidden_dim": [*range(16, 769, 16)],
+    "intermediate_size": [*range(32, 3072, 32)],
+    "n_layers": [*range(1, 13)]
+}
+
+
+def search_args(**kwargs):
+    args = argparse.Namespace(population_size=200, generation_size=20, seq_len=514, batch_size=1, n_inputs=1,
+                              seed=0, cpu_gflops=100.0, mem_bandwidth=20.0)
+    vars(args).update(kwargs)
+    return searcher.target_args(args, 3)
+
+
+def dense_sort(objectives):
+    """Front peeling over the full dominance matrix."""
+    no_worse = (objectives[:, None, :] <= objectives[None, :, :]).all(-1)
+    better = (objectives[:, None, :] < objectives[None, :, :]).any(-1)
+    dominates = no_worse & better
+    rank = np.full(len(objectives), -1)
+    remaining = np.ones(len(objectives), dtype=bool)
+    current = 0
+    while remaining.any():
+        front = np.flatnonzero(remaining)[dominates[remaining][:, remaining].sum(0) == 0]
+        rank[front] = current
+        remaining[front] = False
+        current += 1
+    return rank
+
+
+def test_non_dominated_sort_matches_dense_sort():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        objectives = rng.integers(0, 6, size=(rng.integers(0, 80), rng.integers(1, 4))).astype(np.float64)
+        assert (searcher.non_dominated_sort(objectives) == dense_sort(objectives)).all()
+
+
+def test_random_population_has_several_ranks():
+    nsga = searcher.NSGA_search(search_args(), SEARCH_SPACE)
+    population = nsga.rng.integers(0, nsga.space_sizes, size=(1000, len(searcher.GENE_KEYS))).astype(np.int16)
+    rank = nsga.rank(nsga.cached_cost(nsga.deduplicate(population)))
+    assert rank.max() > 0
+    assert (rank == 0).mean() < 0.5
+
+
+def test_front_is_within_target_size():
+    args = search_args()
+    nsga = searcher.NSGA_search(args, SEARCH_SPACE)
+    nsga.initialization()
+    for _ in range(args.generation_size):
+        nsga.generation()
+    front = nsga.front()
+    assert 1 < len(front) < args.population_size*args.generation_size
+    assert all(point["model_bytes"] <= args.target_size*4 for point in front)